@@ -1,7 +1,407 @@
 #!/usr/bin/python
+import ctypes
+import errno
+import fcntl
+import functools
+import logging
+import os
+import random
 import re
-import smbus
 import sys
+import threading
+import time
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+logger = logging.getLogger(__name__)
+
+# Bus cost of starting one more block write (start, address and register
+# bytes, stop), counted in data bytes
+TRANSACTION_OVERHEAD = 3
+
+def dirtyRanges(old, new, overhead=TRANSACTION_OVERHEAD):
+  "Returns the (start, end) ranges of new that differ from old"
+  ranges = []
+  i = 0
+  length = len(new)
+  while i < length:
+    if old[i] == new[i]:
+      i += 1
+      continue
+    start = i
+    while i < length and old[i] != new[i]:
+      i += 1
+    # Resending a short unchanged gap is cheaper than a new transaction
+    if ranges and start - ranges[-1][1] <= overhead:
+      ranges[-1][1] = i
+    else:
+      ranges.append([start, i])
+  return [tuple(r) for r in ranges]
+
+# ===========================================================================
+# Bus backends
+# ===========================================================================
+# A backend provides the smbus.SMBus method set used by Adafruit_I2C:
+# write_byte, write_byte_data, write_word_data, write_i2c_block_data,
+# read_byte_data, read_word_data and read_i2c_block_data.  Failed
+# transactions raise IOError.
+
+# Largest SMBus block transfer
+SMBUS_BLOCK_MAX = 32
+
+# Operation kinds of an I2CTransaction
+I2C_WRITE = 0
+I2C_READ = 1
+
+class I2CTransaction(object):
+  """
+  A batch of register reads and writes, possibly on several device
+  addresses, run as one combined transfer where the backend supports it
+  (see I2CDevBackend.transfer) and one block transfer per 32 bytes
+  otherwise.  The batch can be run repeatedly, backends keep the buffers
+  they prepared for it.
+  """
+
+  def __init__(self, bus):
+    self.bus = bus
+    self.ops = []
+    self.prepared = None
+
+  def write(self, address, reg, data):
+    "Queues a register write, returns the operation index"
+    self.ops.append((I2C_WRITE, address, reg, bytearray(data)))
+    self.prepared = None
+    return len(self.ops) - 1
+
+  def read(self, address, reg, length):
+    "Queues a register read, returns the index of its result"
+    self.ops.append((I2C_READ, address, reg, length))
+    self.prepared = None
+    return len(self.ops) - 1
+
+  def setData(self, index, data):
+    "Replaces the payload of a queued write with one of the same length"
+    kind, address, reg, old = self.ops[index]
+    if kind != I2C_WRITE or len(data) != len(old):
+      raise ValueError('Only same length write payloads can be replaced')
+    old[:] = bytearray(data)
+
+  def run(self):
+    "Runs the batch, returns a bytearray per read and None per write"
+    transfer = getattr(self.bus, 'transfer', None)
+    if transfer is not None:
+      return transfer(self)
+    return runBlockTransfers(self.bus, self.ops)
+
+def runBlockTransfers(bus, ops):
+  "Runs transaction operations as SMBus block transfers of up to 32 bytes"
+  results = []
+  for kind, address, reg, data in ops:
+    if kind == I2C_WRITE:
+      for start in range(0, len(data), SMBUS_BLOCK_MAX):
+        chunk = data[start:start + SMBUS_BLOCK_MAX]
+        bus.write_i2c_block_data(address, reg + start, [b for b in chunk])
+      results.append(None)
+    else:
+      result = bytearray()
+      for start in range(0, data, SMBUS_BLOCK_MAX):
+        result.extend(bus.read_i2c_block_data(
+          address, reg + start, min(SMBUS_BLOCK_MAX, data - start)))
+      results.append(result)
+  return results
+
+def SMBusBackend(busnum):
+  "Opens the bus through the smbus module"
+  import smbus
+  return smbus.SMBus(busnum)
+
+class i2c_msg(ctypes.Structure):
+  _fields_ = [('addr', ctypes.c_uint16), ('flags', ctypes.c_uint16),
+              ('len', ctypes.c_uint16), ('buf', ctypes.POINTER(ctypes.c_uint8))]
+
+class i2c_rdwr_ioctl_data(ctypes.Structure):
+  _fields_ = [('msgs', ctypes.POINTER(i2c_msg)), ('nmsgs', ctypes.c_uint32)]
+
+class I2CDevBackend(object):
+  "Talks to /dev/i2c-N directly through read/write and the I2C_SLAVE ioctl"
+
+  I2C_SLAVE = 0x0703
+  I2C_RDWR = 0x0707
+  I2C_M_RD = 0x0001
+  # Kernel limit on messages per I2C_RDWR call
+  I2C_RDWR_MAX_MSGS = 42
+
+  def __init__(self, busnum):
+    self.fd = os.open('/dev/i2c-%d' % busnum, os.O_RDWR)
+    self.address = None
+
+  def select(self, address):
+    if address != self.address:
+      fcntl.ioctl(self.fd, self.I2C_SLAVE, address)
+      self.address = address
+
+  def write(self, address, data):
+    self.select(address)
+    os.write(self.fd, bytes(bytearray(data)))
+
+  def read(self, address, reg, length):
+    self.select(address)
+    os.write(self.fd, bytes(bytearray([reg])))
+    return bytearray(os.read(self.fd, length))
+
+  def write_byte(self, address, value):
+    self.write(address, [value])
+
+  def write_byte_data(self, address, reg, value):
+    self.write(address, [reg, value])
+
+  def write_word_data(self, address, reg, value):
+    self.write(address, [reg, value & 0xFF, (value >> 8) & 0xFF])
+
+  def write_i2c_block_data(self, address, reg, data):
+    self.write(address, [reg] + [b for b in data])
+
+  def read_byte_data(self, address, reg):
+    return self.read(address, reg, 1)[0]
+
+  def read_word_data(self, address, reg):
+    data = self.read(address, reg, 2)
+    return data[0] | (data[1] << 8)
+
+  def read_i2c_block_data(self, address, reg, length=SMBUS_BLOCK_MAX):
+    return [b for b in self.read(address, reg, length)]
+
+  def prepare(self, ops):
+    """
+    Builds the i2c_msg arrays for a transaction once.  A write is one
+    message, a read is a register write followed by a read after a
+    repeated start.  Returns the ioctl batches, the write buffers and the
+    read buffers per operation.
+    """
+    msgs = []
+    writes = []
+    reads = []
+    for kind, address, reg, data in ops:
+      if kind == I2C_WRITE:
+        buf = (ctypes.c_uint8 * (len(data) + 1))(reg)
+        msgs.append([(address, 0, len(data) + 1, buf)])
+        writes.append(buf)
+        reads.append(None)
+      else:
+        regBuf = (ctypes.c_uint8 * 1)(reg)
+        buf = (ctypes.c_uint8 * data)()
+        msgs.append([(address, 0, 1, regBuf),
+                     (address, self.I2C_M_RD, data, buf)])
+        writes.append(regBuf)
+        reads.append(buf)
+
+    batches = []
+    current = []
+    for group in msgs:
+      # The register write of a read stays in the same call as its read
+      if len(current) + len(group) > self.I2C_RDWR_MAX_MSGS:
+        batches.append(current)
+        current = []
+      current.extend(group)
+    if current:
+      batches.append(current)
+
+    ioctls = []
+    for batch in batches:
+      array = (i2c_msg * len(batch))()
+      for i, (address, flags, length, buf) in enumerate(batch):
+        array[i].addr = address
+        array[i].flags = flags
+        array[i].len = length
+        array[i].buf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))
+      ioctls.append((i2c_rdwr_ioctl_data(array, len(batch)), array))
+    return ioctls, writes, reads
+
+  def transfer(self, transaction):
+    "Runs a transaction with as few I2C_RDWR calls as the kernel allows"
+    if transaction.prepared is None or transaction.prepared[0] is not self:
+      transaction.prepared = (self, self.prepare(transaction.ops))
+    ioctls, writes, reads = transaction.prepared[1]
+
+    for op, buf in zip(transaction.ops, writes):
+      if op[0] == I2C_WRITE:
+        payload = bytes(op[3])
+        ctypes.memmove(ctypes.addressof(buf) + 1, payload, len(payload))
+    for data, array in ioctls:
+      # The structure is passed as a buffer, an address would be parsed
+      # as a C int and overflow on 64-bit hosts
+      fcntl.ioctl(self.fd, self.I2C_RDWR, data)
+    # The I2C_SLAVE address no longer applies after a combined transfer
+    self.address = None
+    return [None if buf is None else bytearray(buf) for buf in reads]
+
+  def close(self):
+    os.close(self.fd)
+
+class SimulatedBackend(object):
+  """
+  In-memory register file per device address, for running and profiling
+  without hardware.  Every transaction sleeps for latency plus
+  byteLatency per data byte and fails with IOError at errorRate, or for
+  the next failNext transactions.
+  """
+
+  def __init__(self, busnum=0, latency=0.0, byteLatency=0.0, errorRate=0.0,
+               size=256, seed=None):
+    self.busnum = busnum
+    self.latency = latency
+    self.byteLatency = byteLatency
+    self.errorRate = errorRate
+    self.failNext = 0
+    self.size = size
+    self.devices = {}
+    self.random = random.Random(seed)
+    self.stats = {'transactions': 0, 'bytes': 0, 'errors': 0}
+
+  def registers(self, address):
+    if address not in self.devices:
+      self.devices[address] = bytearray(self.size)
+    return self.devices[address]
+
+  def transaction(self, nbytes):
+    self.stats['transactions'] += 1
+    delay = self.latency + self.byteLatency * nbytes
+    if delay:
+      time.sleep(delay)
+    if self.failNext or (self.errorRate and
+                         self.random.random() < self.errorRate):
+      self.failNext = max(0, self.failNext - 1)
+      self.stats['errors'] += 1
+      raise IOError(errno.EREMOTEIO, 'Simulated NAK')
+    self.stats['bytes'] += nbytes
+
+  def write_byte(self, address, value):
+    self.transaction(1)
+
+  def write_byte_data(self, address, reg, value):
+    self.transaction(2)
+    self.registers(address)[reg] = value & 0xFF
+
+  def write_word_data(self, address, reg, value):
+    self.transaction(3)
+    self.registers(address)[reg:reg + 2] = bytearray(
+      [value & 0xFF, (value >> 8) & 0xFF])
+
+  def write_i2c_block_data(self, address, reg, data):
+    if len(data) > SMBUS_BLOCK_MAX:
+      raise OverflowError('SMBus block transfers are limited to 32 bytes')
+    self.transaction(len(data) + 1)
+    self.registers(address)[reg:reg + len(data)] = bytearray(data)
+
+  def read_byte_data(self, address, reg):
+    self.transaction(2)
+    return self.registers(address)[reg]
+
+  def read_word_data(self, address, reg):
+    self.transaction(3)
+    regs = self.registers(address)
+    return regs[reg] | (regs[reg + 1] << 8)
+
+  def read_i2c_block_data(self, address, reg, length=SMBUS_BLOCK_MAX):
+    length = min(length, SMBUS_BLOCK_MAX)
+    self.transaction(length + 1)
+    return [b for b in self.registers(address)[reg:reg + length]]
+
+  def transfer(self, transaction):
+    "Runs a whole transaction as one combined bus transaction"
+    nbytes = 0
+    for kind, address, reg, data in transaction.ops:
+      nbytes += 1 + (len(data) if kind == I2C_WRITE else data)
+    self.transaction(nbytes)
+    results = []
+    for kind, address, reg, data in transaction.ops:
+      regs = self.registers(address)
+      if kind == I2C_WRITE:
+        regs[reg:reg + len(data)] = data
+        results.append(None)
+      else:
+        results.append(regs[reg:reg + data])
+    return results
+
+def openBackend(name, busnum):
+  """
+  Opens a bus backend by name: 'smbus', 'i2cdev' or 'sim'.  The simulated
+  bus takes its timing from ADAFRUIT_I2C_SIM_LATENCY,
+  ADAFRUIT_I2C_SIM_BYTE_LATENCY and ADAFRUIT_I2C_SIM_ERROR_RATE.
+  """
+  if name == 'smbus':
+    return SMBusBackend(busnum)
+  if name == 'i2cdev':
+    return I2CDevBackend(busnum)
+  if name == 'sim':
+    env = os.environ
+    return SimulatedBackend(
+      busnum,
+      latency=float(env.get('ADAFRUIT_I2C_SIM_LATENCY', 0)),
+      byteLatency=float(env.get('ADAFRUIT_I2C_SIM_BYTE_LATENCY', 0)),
+      errorRate=float(env.get('ADAFRUIT_I2C_SIM_ERROR_RATE', 0)))
+  raise ValueError('Unknown I2C backend %r' % name)
+
+# ===========================================================================
+# Bus registry
+# ===========================================================================
+
+class I2CBusRegistry(object):
+  """
+  Opens each bus once per process and shares it, with one lock per bus,
+  between all Adafruit_I2C instances on it.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (backend name, bus number) -> [backend, bus lock, users]
+    self.buses = {}
+    # id(backend) -> (backend, bus lock) for backends passed in as objects
+    self.locks = {}
+
+  def open(self, name, busnum):
+    "Returns the shared backend and lock of a bus, opening it on first use"
+    with self.lock:
+      entry = self.buses.get((name, busnum))
+      if entry is None:
+        entry = [openBackend(name, busnum), threading.RLock(), 0]
+        self.buses[(name, busnum)] = entry
+      entry[2] += 1
+      return entry[0], entry[1]
+
+  def release(self, name, busnum):
+    "Drops one user of a bus and closes it after the last one"
+    with self.lock:
+      entry = self.buses[(name, busnum)]
+      entry[2] -= 1
+      if entry[2] == 0:
+        del self.buses[(name, busnum)]
+        if hasattr(entry[0], 'close'):
+          entry[0].close()
+
+  def lockFor(self, backend):
+    "Returns the lock serializing access to a backend object"
+    with self.lock:
+      if id(backend) not in self.locks:
+        self.locks[id(backend)] = (backend, threading.RLock())
+      return self.locks[id(backend)][1]
+
+  def getStats(self):
+    with self.lock:
+      return dict(('%s:%d' % key, entry[2])
+                  for key, entry in self.buses.items())
+
+busRegistry = I2CBusRegistry()
+
+def locked(method):
+  "Runs an Adafruit_I2C method while holding the lock of its bus"
+  @functools.wraps(method)
+  def wrapper(self, *args, **kwargs):
+    with self.lock:
+      return method(self, *args, **kwargs)
+  return wrapper
 
 # ===========================================================================
 # Adafruit_I2C Class
@@ -9,9 +409,19 @@ import sys
 
 class Adafruit_I2C(object):
 
+  # Board revision, read from /proc/cpuinfo once per process
+  piRevision = None
+
   @staticmethod
   def getPiRevision():
     "Gets the version number of the Raspberry Pi board"
+    if Adafruit_I2C.piRevision is None:
+      Adafruit_I2C.piRevision = Adafruit_I2C.readPiRevision()
+    return Adafruit_I2C.piRevision
+
+  @staticmethod
+  def readPiRevision():
+    "Reads the version number of the Raspberry Pi board from /proc/cpuinfo"
     # Revision list available at: http://elinux.org/RPi_HardwareHistory#Board_Revision_History
     try:
       with open('/proc/cpuinfo', 'r') as infile:
@@ -35,14 +445,96 @@ class Adafruit_I2C(object):
     # Gets the I2C bus number /dev/i2c#
     return 1 if Adafruit_I2C.getPiRevision() > 1 else 0
 
-  def __init__(self, address, busnum=-1, debug=False):
+  def __init__(self, address, busnum=-1, debug=False, shadow=False,
+               shadowSize=256, backend=None):
     self.address = address
     # By default, the correct I2C bus is auto-detected using /proc/cpuinfo
     # Alternatively, you can hard-code the bus version below:
     # self.bus = smbus.SMBus(0); # Force I2C0 (early 256MB Pi's)
     # self.bus = smbus.SMBus(1); # Force I2C1 (512MB Pi's)
-    self.bus = smbus.SMBus(busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber())
+    busnum = busnum if busnum >= 0 else Adafruit_I2C.getPiI2CBusNumber()
+    # The backend is a name for openBackend, by default taken from the
+    # ADAFRUIT_I2C_BACKEND environment variable, or a backend object.
+    # Named buses are shared through busRegistry.
+    if backend is None:
+      backend = os.environ.get('ADAFRUIT_I2C_BACKEND', 'smbus')
+    if isinstance(backend, str):
+      self.busKey = (backend, busnum)
+      self.bus, self.lock = busRegistry.open(backend, busnum)
+    else:
+      self.busKey = None
+      self.bus = backend
+      self.lock = busRegistry.lockFor(backend)
     self.debug = debug
+    self.deltaStats = {'frames': 0, 'transactions': 0, 'bytes': 0, 'saved': 0}
+    self.shadow = None
+    if shadow:
+      self.enableShadow(shadowSize)
+
+  def close(self):
+    "Releases the shared bus"
+    if self.busKey is not None:
+      busRegistry.release(*self.busKey)
+      self.busKey = None
+
+  # Shadow registers: an in-memory copy of the device register file, only
+  # valid when this process is the sole writer. Block transfers assume the
+  # device auto-increments its register pointer.
+
+  def enableShadow(self, size=256):
+    "Serves register reads from memory and mirrors every register write"
+    self.shadow = bytearray(size)
+    # One flag per register, set while the shadow copy has to be re-read
+    self.stale = bytearray(b'\x01') * size
+    self.volatile = []
+
+  def setVolatile(self, reg, length, maxAge):
+    "Re-reads a register range from the device once it is maxAge seconds old"
+    self.volatile.append([reg, reg + length, maxAge, 0.0])
+
+  @locked
+  def invalidate(self, reg=0, length=None):
+    "Marks registers stale so the next read goes to the device"
+    if self.shadow is None:
+      return
+    end = len(self.shadow) if length is None else reg + length
+    self.stale[reg:end] = bytearray(b'\x01') * (end - reg)
+
+  @locked
+  def resync(self, reg=0, length=None):
+    "Reloads registers from the device into the shadow copy"
+    if self.shadow is None:
+      return
+    end = len(self.shadow) if length is None else reg + length
+    for start in range(reg, end, 32):
+      self.invalidate(start, min(32, end - start))
+      self.readList(start, min(32, end - start))
+
+  def shadowCovers(self, reg, length):
+    return self.shadow is not None and reg + length <= len(self.shadow)
+
+  def shadowLookup(self, reg, length):
+    "Returns the shadowed bytes of a register range, None on a miss"
+    if not self.shadowCovers(reg, length):
+      return None
+    end = reg + length
+    if self.volatile:
+      now = time.time()
+      for entry in self.volatile:
+        if entry[0] < end and reg < entry[1] and now - entry[3] > entry[2]:
+          self.invalidate(entry[0], entry[1] - entry[0])
+          entry[3] = now
+    if b'\x01' in self.stale[reg:end]:
+      return None
+    return self.shadow[reg:end]
+
+  def shadowStore(self, reg, data):
+    "Records bytes written to or read from the device"
+    if not self.shadowCovers(reg, len(data)):
+      return
+    end = reg + len(data)
+    self.shadow[reg:end] = bytearray(data)
+    self.stale[reg:end] = bytearray(len(data))
 
   def reverseByteOrder(self, data):
     "Reverses the byte order of an int (16-bit) or long (32-bit) value"
@@ -55,94 +547,175 @@ class Adafruit_I2C(object):
     return val
 
   def errMsg(self):
-    print "Error accessing 0x%02X: Check your I2C address" % self.address
+    logger.error("Error accessing 0x%02X: Check your I2C address", self.address)
     return -1
 
+  @locked
   def write8(self, reg, value):
     "Writes an 8-bit value to the specified register/address"
     try:
       self.bus.write_byte_data(self.address, reg, value)
+      self.shadowStore(reg, [value & 0xFF])
       if self.debug:
-        print "I2C: Wrote 0x%02X to register 0x%02X" % (value, reg)
-    except IOError, err:
+        logger.debug("I2C: Wrote 0x%02X to register 0x%02X", value, reg)
+    except IOError as err:
       return self.errMsg()
 
+  @locked
   def write16(self, reg, value):
     "Writes a 16-bit value to the specified register/address pair"
     try:
       self.bus.write_word_data(self.address, reg, value)
+      self.shadowStore(reg, [value & 0xFF, (value >> 8) & 0xFF])
       if self.debug:
-        print ("I2C: Wrote 0x%02X to register pair 0x%02X,0x%02X" %
-         (value, reg, reg+1))
-    except IOError, err:
+        logger.debug("I2C: Wrote 0x%02X to register pair 0x%02X,0x%02X",
+         value, reg, reg+1)
+    except IOError as err:
       return self.errMsg()
 
+  @locked
   def writeRaw8(self, value):
     "Writes an 8-bit value on the bus"
     try:
       self.bus.write_byte(self.address, value)
       if self.debug:
-        print "I2C: Wrote 0x%02X" % value
-    except IOError, err:
+        logger.debug("I2C: Wrote 0x%02X", value)
+    except IOError as err:
       return self.errMsg()
 
+  def transaction(self):
+    "Starts a combined transaction on the bus of this device"
+    return I2CTransaction(self.bus)
+
+  @locked
+  def execute(self, transaction):
+    "Runs a transaction and keeps the shadow registers of this device current"
+    try:
+      results = transaction.run()
+    except Exception as err:
+      # Backends may fail with more than IOError, e.g. on malformed ioctls
+      logger.debug("I2C: Transaction failed: %r", err)
+      return self.errMsg()
+    for (kind, address, reg, data), result in zip(transaction.ops, results):
+      if address == self.address:
+        self.shadowStore(reg, data if kind == I2C_WRITE else result)
+    return results
+
+  @locked
   def writeList(self, reg, list):
     "Writes an array of bytes using I2C format"
+    if len(list) > SMBUS_BLOCK_MAX:
+      transaction = self.transaction()
+      transaction.write(self.address, reg, list)
+      if self.execute(transaction) == -1:
+        return -1
+      return
     try:
       if self.debug:
-        print "I2C: Writing list to register 0x%02X:" % reg
-        print list
+        logger.debug("I2C: Writing list to register 0x%02X: %r", reg, list)
       self.bus.write_i2c_block_data(self.address, reg, list)
-    except IOError, err:
+      self.shadowStore(reg, list)
+    except IOError as err:
       return self.errMsg()
 
+  @locked
+  def writeListDelta(self, reg, list, overhead=TRANSACTION_OVERHEAD):
+    "Writes only the bytes that differ from the shadow copy of the registers"
+    data = bytearray(list)
+    old = self.shadowLookup(reg, len(data))
+    ranges = [(0, len(data))] if old is None else dirtyRanges(old, data, overhead)
+    stats = self.deltaStats
+    stats['frames'] += 1
+    if len(ranges) > 1:
+      # Several dirty ranges go out as one combined transfer
+      transaction = self.transaction()
+      for start, end in ranges:
+        transaction.write(self.address, reg + start, data[start:end])
+      if self.execute(transaction) == -1:
+        return -1
+    elif ranges:
+      start, end = ranges[0]
+      if self.writeList(reg + start, [b for b in data[start:end]]) == -1:
+        return -1
+    for start, end in ranges:
+      stats['transactions'] += 1
+      stats['bytes'] += end - start + overhead
+    stats['saved'] += len(data) + overhead - sum(
+      end - start + overhead for start, end in ranges)
+
+  @locked
   def readList(self, reg, length):
     "Read a list of bytes from the I2C device"
+    cached = self.shadowLookup(reg, length)
+    if cached is not None:
+      return list(cached)
+    if length > SMBUS_BLOCK_MAX:
+      transaction = self.transaction()
+      transaction.read(self.address, reg, length)
+      results = self.execute(transaction)
+      return -1 if results == -1 else [b for b in results[0]]
     try:
       results = self.bus.read_i2c_block_data(self.address, reg, length)
+      self.shadowStore(reg, results)
       if self.debug:
-        print ("I2C: Device 0x%02X returned the following from reg 0x%02X" %
-         (self.address, reg))
-        print results
+        logger.debug("I2C: Device 0x%02X returned the following from reg 0x%02X: %r",
+         self.address, reg, results)
       return results
-    except IOError, err:
+    except IOError as err:
       return self.errMsg()
 
+  @locked
   def readU8(self, reg):
     "Read an unsigned byte from the I2C device"
+    cached = self.shadowLookup(reg, 1)
+    if cached is not None:
+      return cached[0]
     try:
       result = self.bus.read_byte_data(self.address, reg)
+      self.shadowStore(reg, [result & 0xFF])
       if self.debug:
-        print ("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X" %
-         (self.address, result & 0xFF, reg))
+        logger.debug("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X",
+         self.address, result & 0xFF, reg)
       return result
-    except IOError, err:
+    except IOError as err:
       return self.errMsg()
 
+  @locked
   def readS8(self, reg):
     "Reads a signed byte from the I2C device"
+    cached = self.shadowLookup(reg, 1)
+    if cached is not None:
+      result = cached[0]
+      return result - 256 if result > 127 else result
     try:
       result = self.bus.read_byte_data(self.address, reg)
+      self.shadowStore(reg, [result & 0xFF])
       if result > 127: result -= 256
       if self.debug:
-        print ("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X" %
-         (self.address, result & 0xFF, reg))
+        logger.debug("I2C: Device 0x%02X returned 0x%02X from reg 0x%02X",
+         self.address, result & 0xFF, reg)
       return result
-    except IOError, err:
+    except IOError as err:
       return self.errMsg()
 
+  @locked
   def readU16(self, reg, little_endian=True):
     "Reads an unsigned 16-bit value from the I2C device"
+    cached = self.shadowLookup(reg, 2)
     try:
-      result = self.bus.read_word_data(self.address,reg)
+      if cached is not None:
+        result = cached[0] | (cached[1] << 8)
+      else:
+        result = self.bus.read_word_data(self.address,reg)
+        self.shadowStore(reg, [result & 0xFF, (result >> 8) & 0xFF])
       # Swap bytes if using big endian because read_word_data assumes little 
       # endian on ARM (little endian) systems.
       if not little_endian:
         result = ((result << 8) & 0xFF00) + (result >> 8)
       if (self.debug):
-        print "I2C: Device 0x%02X returned 0x%04X from reg 0x%02X" % (self.address, result & 0xFFFF, reg)
+        logger.debug("I2C: Device 0x%02X returned 0x%04X from reg 0x%02X", self.address, result & 0xFFFF, reg)
       return result
-    except IOError, err:
+    except IOError as err:
       return self.errMsg()
 
   def readS16(self, reg, little_endian=True):
@@ -151,20 +724,106 @@ class Adafruit_I2C(object):
       result = self.readU16(reg,little_endian)
       if result > 32767: result -= 65536
       return result
-    except IOError, err:
+    except IOError as err:
       return self.errMsg()
 
+# ===========================================================================
+# Adafruit_I2CWorker Class
+# ===========================================================================
+
+class Adafruit_I2CWorker(object):
+  """
+  Runs I2C transactions on a dedicated thread so a slow or NAKed transfer
+  never blocks the caller.  Results are passed to callbacks through
+  dispatch, e.g. GObject.idle_add to get back onto the main loop.  The
+  optional observer gets the name, duration and outcome of every
+  transaction the same way.
+  """
+
+  def __init__(self, maxsize=32, dispatch=None, observer=None):
+    self.requests = queue.Queue(maxsize)
+    self.dispatch = dispatch if dispatch is not None else self.callDirect
+    self.observer = observer
+    self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0,
+                  'maxDepth': 0, 'latencyTotal': 0.0, 'latencyMax': 0.0,
+                  'waitTotal': 0.0, 'waitMax': 0.0}
+    self.thread = threading.Thread(target=self.run, name='i2c-worker')
+    self.thread.daemon = True
+    self.thread.start()
+
+  @staticmethod
+  def callDirect(func, *args):
+    func(*args)
+
+  def submit(self, func, args=(), callback=None, errback=None):
+    "Queues func(*args), returns False if the queue is full"
+    try:
+      self.requests.put_nowait((func, args, callback, errback, time.time()))
+    except queue.Full:
+      self.stats['rejected'] += 1
+      return False
+    self.stats['submitted'] += 1
+    self.stats['maxDepth'] = max(self.stats['maxDepth'], self.requests.qsize())
+    return True
+
+  def run(self):
+    while True:
+      request = self.requests.get()
+      if request is None:
+        return
+      func, args, callback, errback, queued = request
+      start = time.time()
+      try:
+        result = func(*args)
+        error = None
+      except Exception as e:
+        result = None
+        error = e
+      end = time.time()
+
+      stats = self.stats
+      stats['waitTotal'] += start - queued
+      stats['waitMax'] = max(stats['waitMax'], start - queued)
+      stats['latencyTotal'] += end - start
+      stats['latencyMax'] = max(stats['latencyMax'], end - start)
+      if self.observer is not None:
+        # The Adafruit_I2C methods report bus errors by returning -1
+        self.dispatch(self.observer, getattr(func, '__name__', 'i2c'),
+                      end - start, error is not None or result == -1)
+      if error is not None:
+        stats['failed'] += 1
+        if errback is not None:
+          self.dispatch(errback, error)
+      else:
+        stats['completed'] += 1
+        if callback is not None:
+          self.dispatch(callback, result)
+
+  def stop(self):
+    "Finishes the queued transactions and ends the worker thread"
+    self.requests.put(None)
+    self.thread.join()
+
+  def getStats(self):
+    "Returns the counters along with the current queue depth and averages"
+    stats = dict(self.stats)
+    done = stats['completed'] + stats['failed']
+    stats['depth'] = self.requests.qsize()
+    stats['latencyAvg'] = stats['latencyTotal'] / done if done else 0.0
+    stats['waitAvg'] = stats['waitTotal'] / done if done else 0.0
+    return stats
+
 if __name__ == '__main__':
   try:
     bus = Adafruit_I2C(address=114, busnum=1, debug=True)
-    print "Default I2C bus is accessible"
+    print("Default I2C bus is accessible")
   except:
-    print "Error accessing default I2C bus"
+    print("Error accessing default I2C bus")
   bus.readList(00, 16)
   #bus.writeList(00, [255,255,1,128,1,128,1,128,1,128,1,128,1,128,255,255])
   #bus.readList(00, 16)
   if len(sys.argv) == 2:
-    list = map(int, sys.argv[1].split(','))
-    print list
+    list = [int(x) for x in sys.argv[1].split(",")]
+    print(list)
     bus.writeList(00, list)
 
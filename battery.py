@@ -1,9 +1,80 @@
 #!/usr/bin/python
 
+import array
+import struct
+import time
+
 from gatt import *
+from gatt_log import setup_logging
+
+logger = logging.getLogger(__name__)
 
 mainloop = None
 
+# History samples as read by clients: timestamp in seconds, level.
+HISTORY_RECORD = struct.Struct('<IB')
+
+
+class BatteryHistory(object):
+    """
+    Fixed-capacity ring of timestamped battery level samples.
+
+    Timestamps are kept in an array of uint32 and levels in a bytearray,
+    5 bytes per sample.  Once full the oldest samples are overwritten.
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.timestamps = array.array('I', [0] * capacity)
+        self.levels = bytearray(capacity)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, level, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        end = (self.start + self.count) % self.capacity
+        self.timestamps[end] = int(timestamp) & 0xffffffff
+        self.levels[end] = level
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def timestamp_at(self, i):
+        return self.timestamps[(self.start + i) % self.capacity]
+
+    def first_after(self, timestamp):
+        # Samples are appended in time order, so the ring is sorted
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp_at(mid) <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def encode(self, since=0, limit=None):
+        """
+        Returns up to limit samples newer than since, oldest first, as
+        packed HISTORY_RECORDs.
+
+        """
+        first = self.first_after(since)
+        n = self.count - first
+        if limit is not None:
+            n = min(n, limit)
+        out = bytearray(n * HISTORY_RECORD.size)
+        for i in range(n):
+            j = (self.start + first + i) % self.capacity
+            HISTORY_RECORD.pack_into(out, i * HISTORY_RECORD.size,
+                                     self.timestamps[j], self.levels[j])
+        return out
+
+
 class BatteryAdvertisement(Advertisement):
 
     def __init__(self, bus, index):
@@ -18,7 +89,10 @@ class BatteryService(Service):
 
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, self.BATTERY_UUID, True)
-        self.add_characteristic(BatteryLevelCharacteristic(bus, 0, self))
+        level = BatteryLevelCharacteristic(bus, 0, self)
+        self.add_characteristic(level)
+        self.add_characteristic(BatteryHistoryCharacteristic(
+                bus, 1, self, level.history))
 
 class BatteryLevelCharacteristic(Characteristic):
     BATTERY_LVL_UUID = '2a19'
@@ -29,17 +103,19 @@ class BatteryLevelCharacteristic(Characteristic):
                 self.BATTERY_LVL_UUID,
                 ['read', 'write', 'notify'],
                 service)
-        self.notifying = False
         self.battery_lvl = 100
         self.charging = False
-        GObject.timeout_add(5000, self.drain_battery)
+        self.notify_acquired = False
+        self.notify_rate = 1
+        self.history = BatteryHistory()
+        # Not tied to this characteristic, the history keeps sampling
+        # while no client is subscribed.
+        tick_scheduler.add(5, self.drain_battery)
 
     def notify_battery_level(self):
-        if not self.notifying:
+        if not self.is_notifying():
             return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                { 'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        self.notify_value(bytearray([self.battery_lvl]))
 
     def drain_battery(self):
         if self.charging:
@@ -57,97 +133,107 @@ class BatteryLevelCharacteristic(Characteristic):
             else:
                 self.charging = True
 
-        print('Battery Level drained: ' + repr(self.battery_lvl))
+        logger.debug('Battery Level drained: %r', self.battery_lvl)
+        self.history.append(self.battery_lvl)
         self.notify_battery_level()
         return True
 
-    def ReadValue(self, options):
-        print('Battery Level read: ' + repr(self.battery_lvl))
-        return [dbus.Byte(self.battery_lvl)]
+    def read_value(self, options):
+        logger.debug('Battery Level read: %r', self.battery_lvl)
+        return bytearray([self.battery_lvl])
 
-    def WriteValue(self, value, options):
-        print('Battery Level write')
+    def write_value(self, value, options):
+        logger.debug('Battery Level write')
         if len(value) != 1:
             raise InvalidValueLengthException()
 
         byte = value[0]
-        print('write value: ' +repr(byte))
+        logger.debug('write value: %r', byte)
         if byte < 0 or byte > 100:
             raise NotPermittedException()
         self.battery_lvl = byte
 
-    def StartNotify(self):
-        if self.notifying:
-            print('Already notifying, nothing to do')
-            return
-
-        self.notifying = True
+    def start_notify(self):
+        logger.debug('Battery Level notifications started')
         self.notify_battery_level()
 
-    def StopNotify(self):
-        if not self.notifying:
-            print('Not notifying, nothing to do')
-            return
+    def stop_notify(self):
+        logger.debug('Battery Level notifications stopped')
 
-        self.notifying = False
 
-def register_app_cb():
-    print('GATT application registered')
+class BatteryHistoryCharacteristic(Characteristic):
+    """
+    Bulk read access to the battery level history.
 
+    A read returns as many samples newer than the device's cursor as fit
+    in one attribute value, long reads continue from the same snapshot.
+    Writing a uint32 timestamp moves the cursor, clients sync by writing
+    the timestamp of the last sample they received and reading again.
+    The cursor lives in the device session and is forgotten on disconnect.
 
-def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
-    mainloop.quit()
+    """
+    BATTERY_HISTORY_UUID = '12345678-1234-5678-1234-56789abc1f0f'
+
+    def __init__(self, bus, index, service, history):
+        Characteristic.__init__(
+                self, bus, index,
+                self.BATTERY_HISTORY_UUID,
+                ['read', 'write'],
+                service)
+        self.history = history
+        self.value_length = 4
+
+    def read_value(self, options):
+        since = self.get_session(options.get('device')).get('cursor', 0)
+        value = self.history.encode(
+                since, ATT_MAX_VALUE_LENGTH // HISTORY_RECORD.size)
+        logger.debug('Battery History read: %d samples since %d',
+                     len(value) // HISTORY_RECORD.size, since)
+        return value
+
+    def write_value(self, value, options):
+        self.get_session(options.get('device'))['cursor'] = \
+                struct.unpack('<I', bytes(value))[0]
 
-def register_ad_cb():
-    print 'Advertisement registered'
+def register_app_cb(adapter):
+    logger.info('GATT application registered with %s', adapter.path)
 
 
-def register_ad_error_cb(error):
-    print 'Failed to register advertisement: ' + str(error)
+def register_app_error_cb(error):
+    logger.error('Failed to register application: %s', error)
     mainloop.quit()
 
 def main():
     global mainloop
 
+    setup_logging()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     bus = dbus.SystemBus()
 
-    ad_man = find_ad_manager(bus)
-    if not ad_man:
-        print 'LEAdvertisingManager1 interface not found'
+    adapters = AdapterPool(bus)
+    if not adapters.adapters:
+        logger.error('No adapter with GattManager1 found')
         return
 
-    ad_man_props = find_interface(bus, ad_man, "org.freedesktop.DBus.Properties")
-
-    ad_man_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-
-    ad_manager = find_ad_interface(bus, ad_man)
+    adapters.power_on()
 
     battery_advertisement = BatteryAdvertisement(bus, 0)
 
-
-    gatt_man = find_gatt_manager(bus)
-    if not gatt_man:
-        print('GattManager1 interface not found')
-        return
-
-    service_manager = find_gatt_interface(bus, gatt_man)
-
     app = Application(bus)
 
     app.add_service(BatteryService(bus, 0))
 
-    mainloop = GObject.MainLoop()
+    StatsObject(bus, adapters=adapters)
+    LogControlObject(bus)
+    dump_stats_on_signal('/tmp/battery_gatt_stats.json')
 
-    ad_manager.RegisterAdvertisement(battery_advertisement.get_path(), {},
-                                     reply_handler=register_ad_cb,
-                                     error_handler=register_ad_error_cb)
+    mainloop = GObject.MainLoop()
 
-    service_manager.RegisterApplication(app.get_path(), {},
-                                    reply_handler=register_app_cb,
-                                    error_handler=register_app_error_cb)
+    adapters.register_application(app,
+                                  reply_handler=register_app_cb,
+                                  error_handler=register_app_error_cb,
+                                  advertisement=battery_advertisement)
 
     mainloop.run()
 
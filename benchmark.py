@@ -0,0 +1,551 @@
+#!/usr/bin/python
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import dbus.bus
+import dbus.lowlevel
+
+from adafruit_i2c import Adafruit_I2C, SimulatedBackend
+from battery import BatteryHistoryCharacteristic
+from gatt import *
+from mock_bluez import MockAdapter, MOCK_CONTROL_IFACE
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Payloads for the server write benchmark, by UUID, where the current value
+# is not a valid write.  Other characteristics get their value written back.
+WRITE_PAYLOADS = {
+        # A uint32 history cursor, 0 keeps every sample
+        BatteryHistoryCharacteristic.BATTERY_HISTORY_UUID: b'\0\0\0\0',
+}
+
+# The micro benchmarks create objects without a bus connection, gatt's
+# init_object leaves them unexported, so they run without BlueZ or a D-Bus
+# daemon.  The server benchmarks start a private dbus-daemon instead.
+
+
+def build_service(bus, index, n_chrcs):
+    service = Service(bus, index, '180f', True)
+    for i in range(n_chrcs):
+        chrc = Characteristic(bus, i, '2a19', ['read', 'notify'], service)
+        chrc.add_descriptor(Descriptor(bus, 0, '2901', ['read'], chrc))
+        service.add_characteristic(chrc)
+    return service
+
+
+def build_app(n_attributes, chrcs_per_service=10, bus=None):
+    app = Application(bus)
+    for i in range(0, n_attributes, chrcs_per_service):
+        app.add_service(build_service(
+                bus, i // chrcs_per_service,
+                min(chrcs_per_service, n_attributes - i)))
+    return app
+
+
+def build_schema(n_attributes, chrcs_per_service=10):
+    # The same tree as build_app, as a schema
+    services = []
+    for i in range(n_attributes):
+        if i % chrcs_per_service == 0:
+            chrcs = []
+            services.append({'uuid': '180f', 'characteristics': chrcs})
+        chrcs.append({'uuid': '2a19', 'flags': ['read', 'notify'],
+                      'value': [100],
+                      'descriptors': [{'uuid': '2901', 'value': 'Level'}]})
+    return {'services': services}
+
+
+def bench_managed_objects(args):
+    print('%10s %16s %16s' % ('attributes', 'rebuild (us)', 'cached (us)'))
+    for n in args.sizes:
+        app = build_app(n)
+        objects = [obj for service in app.services
+                   for obj in object_tree(service)]
+
+        def rebuild():
+            # Property dicts are cached per object too, a full rebuild
+            # starts without them.
+            for obj in objects:
+                obj.invalidate_properties()
+            app.build_managed_objects()
+
+        rebuild = min(timeit.repeat(rebuild, number=args.number, repeat=3))
+        app.GetManagedObjects()
+        cached = min(timeit.repeat(app.GetManagedObjects,
+                                   number=args.number, repeat=3))
+        print('%10d %16.1f %16.3f' % (n, rebuild / args.number * 1e6,
+                                      cached / args.number * 1e6))
+
+
+def marshal(value):
+    # Appending to a message runs the real libdbus marshalling without
+    # needing a connection.
+    message = dbus.lowlevel.SignalMessage('/', DBUS_PROP_IFACE,
+                                          'PropertiesChanged')
+    message.append(value, signature='ay')
+
+
+def bench_value_encoding(args):
+    print('%8s %18s %18s %18s' % ('bytes', 'dbus.Byte list (us)',
+                                  'codec (us)', 'codec cached (us)'))
+    for n in args.sizes:
+        data = bytearray(i & 0xff for i in range(n))
+
+        def per_byte():
+            marshal([dbus.Byte(x) for x in data])
+
+        def codec():
+            marshal(ValueCodec().encode(data))
+
+        cached_codec = ValueCodec()
+
+        def cached():
+            marshal(cached_codec.encode(data))
+
+        results = []
+        for func in (per_byte, codec, cached):
+            best = min(timeit.repeat(func, number=args.number, repeat=3))
+            results.append(best / args.number * 1e6)
+        print('%8d %18.2f %18.2f %18.2f' % tuple([n] + results))
+
+
+def led_frames(count, seed=1):
+    # Interactive LED control: every frame toggles a single LED
+    rng = random.Random(seed)
+    frame = bytearray(16)
+    frames = []
+    for i in range(count):
+        frame[rng.randrange(16)] ^= 1 << rng.randrange(8)
+        frames.append(list(frame))
+    return frames
+
+
+def bench_led_i2c(args):
+    frames = led_frames(args.frames)
+    print('%-24s %10s %12s %10s %10s' % ('mode', 'frames/s', 'transactions',
+                                         'bus bytes', 'errors'))
+    for label, shadow in (('write + read back', False),
+                          ('shadow + delta write', True)):
+        backend = SimulatedBackend(latency=args.latency,
+                                   byteLatency=args.byte_latency,
+                                   errorRate=args.error_rate, seed=1)
+        device = Adafruit_I2C(0x70, 1, shadow=shadow, backend=backend)
+        write = device.writeListDelta if shadow else device.writeList
+        start = time.time()
+        for frame in frames:
+            write(0, frame)
+            device.readList(0, 16)
+        elapsed = time.time() - start
+        stats = backend.stats
+        print('%-24s %10.1f %12d %10d %10d' % (
+                label, len(frames) / elapsed, stats['transactions'],
+                stats['bytes'], stats['errors']))
+
+
+def bench_i2c_transaction(args):
+    # Reads args.ranges register ranges spread over two devices, once as
+    # separate block reads and once as a single combined transaction.
+    print('%-20s %10s %12s %10s' % ('mode', 'batches/s', 'transactions',
+                                     'bus bytes'))
+    for label in ('separate block reads', 'combined transaction'):
+        backend = SimulatedBackend(latency=args.latency,
+                                   byteLatency=args.byte_latency)
+        devices = [Adafruit_I2C(0x70, 1, backend=backend),
+                   Adafruit_I2C(0x71, 1, backend=backend)]
+        transaction = devices[0].transaction()
+        for i in range(args.ranges):
+            transaction.read(devices[i % 2].address, i * args.length,
+                             args.length)
+
+        start = time.time()
+        for n in range(args.number):
+            if label == 'combined transaction':
+                devices[0].execute(transaction)
+            else:
+                for i in range(args.ranges):
+                    devices[i % 2].readList(i * args.length, args.length)
+        elapsed = time.time() - start
+        print('%-20s %10.1f %12d %10d' % (
+                label, args.number / elapsed,
+                backend.stats['transactions'], backend.stats['bytes']))
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                               '--print-address=1'],
+                              stdout=subprocess.PIPE)
+    address = daemon.stdout.readline().decode('ascii').strip()
+    return daemon, address
+
+
+def spawn(script, address, *args):
+    # dbus.SystemBus() honours DBUS_SYSTEM_BUS_ADDRESS, so the servers run
+    # unmodified against the private bus, with I2C devices simulated.
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address)
+    env.setdefault('ADAFRUIT_I2C_BACKEND', 'sim')
+    return subprocess.Popen([sys.executable, os.path.join(HERE, script)] +
+                            list(args), env=env)
+
+
+def server_command(name):
+    # aio:battery runs battery.py's services on the asyncio backend
+    if name.startswith('aio:'):
+        return 'gatt_aio.py', name[4:]
+    return (name,)
+
+
+def call_async(mainloop, method, *args, **kwargs):
+    # Runs the main loop until the call returns, so an application
+    # exported from this process is served meanwhile.
+    result = []
+
+    def reply_cb(*values):
+        result.append(values)
+        mainloop.quit()
+
+    def error_cb(error):
+        result.append(error)
+        mainloop.quit()
+
+    method(*args, reply_handler=reply_cb, error_handler=error_cb, **kwargs)
+    mainloop.run()
+    if isinstance(result[0], Exception):
+        raise result[0]
+    return result[0]
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    return None
+
+
+def rss_kb(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+class LoadDriver(object):
+    """
+    Keeps concurrency asynchronous calls in flight against a set of
+    characteristics until count operations have completed.
+
+    """
+    def __init__(self, proxies, operation, concurrency, count):
+        self.proxies = proxies
+        self.operation = operation
+        self.concurrency = concurrency
+        self.count = count
+        self.issued = 0
+        self.completed = 0
+        self.errors = 0
+        self.latencies = []
+        self.mainloop = GObject.MainLoop()
+
+    def run(self):
+        start = time.time()
+        for i in range(min(self.concurrency, self.count)):
+            self.issue()
+        self.mainloop.run()
+        self.elapsed = time.time() - start
+        self.latencies.sort()
+
+    def issue(self):
+        proxy, value = self.proxies[self.issued % len(self.proxies)]
+        self.issued += 1
+        start = time.time()
+
+        def reply_cb(*args):
+            self.done(start, False)
+
+        def error_cb(error):
+            self.done(start, True)
+
+        if self.operation == 'read':
+            proxy.ReadValue({}, dbus_interface=GATT_CHRC_IFACE,
+                            reply_handler=reply_cb, error_handler=error_cb)
+        elif self.operation == 'write':
+            proxy.WriteValue(value, {}, dbus_interface=GATT_CHRC_IFACE,
+                             reply_handler=reply_cb, error_handler=error_cb)
+        else:
+            def started_cb():
+                proxy.StopNotify(dbus_interface=GATT_CHRC_IFACE,
+                                 reply_handler=reply_cb,
+                                 error_handler=error_cb)
+
+            proxy.StartNotify(dbus_interface=GATT_CHRC_IFACE,
+                              reply_handler=started_cb,
+                              error_handler=error_cb)
+
+    def done(self, start, failed):
+        self.latencies.append(time.time() - start)
+        self.completed += 1
+        if failed:
+            self.errors += 1
+        if self.issued < self.count:
+            self.issue()
+        elif self.completed == self.count:
+            self.mainloop.quit()
+
+
+def bench_server(args):
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_private_bus()
+    processes = [spawn('mock_bluez.py', address)]
+    try:
+        bus = dbus.bus.BusConnection(address)
+        if not wait_for(lambda: bus.name_has_owner(BLUEZ_SERVICE_NAME), 10):
+            print('Mock BlueZ did not start')
+            return
+        control = dbus.Interface(
+                bus.get_object(BLUEZ_SERVICE_NAME,
+                               MockAdapter.PATH_BASE + '0'),
+                MOCK_CONTROL_IFACE)
+
+        print('%-12s %-6s %8s %10s %9s %9s %7s %10s %9s' % (
+                'server', 'op', 'ops', 'ops/s', 'p50 (ms)', 'p99 (ms)',
+                'errors', 'RSS (kB)', 'start (s)'))
+        for script in args.servers:
+            known = set(c[0] for c in control.ListCharacteristics())
+            start = time.time()
+            command = server_command(script)
+            server = spawn(command[0], address, *command[1:])
+            processes.append(server)
+            chrcs = wait_for(
+                    lambda: [c for c in control.ListCharacteristics()
+                             if c[0] not in known], args.timeout)
+            if not chrcs:
+                print('%-12s did not register an application' % script)
+                continue
+            startup = time.time() - start
+
+            for operation, flag in (('read', 'read'), ('write', 'write'),
+                                    ('notify', 'notify')):
+                proxies = []
+                for owner, path, uuid, flags in chrcs:
+                    if flag not in flags:
+                        continue
+                    proxy = bus.get_object(owner, path)
+                    value = None
+                    if operation == 'write' and uuid in WRITE_PAYLOADS:
+                        value = dbus.ByteArray(WRITE_PAYLOADS[uuid])
+                    elif operation == 'write':
+                        value = proxy.ReadValue(
+                                {}, dbus_interface=GATT_CHRC_IFACE,
+                                byte_arrays=True)
+                    proxies.append((proxy, value))
+                if not proxies:
+                    continue
+
+                driver = LoadDriver(proxies, operation, args.concurrency,
+                                    args.count)
+                driver.run()
+                print('%-12s %-6s %8d %10.1f %9.3f %9.3f %7d %10d %9.2f' % (
+                        script, operation, driver.completed,
+                        driver.completed / driver.elapsed,
+                        percentile(driver.latencies, 0.5) * 1e3,
+                        percentile(driver.latencies, 0.99) * 1e3,
+                        driver.errors, rss_kb(server.pid), startup))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        daemon.terminate()
+        daemon.wait()
+
+
+def bench_schema_startup(args):
+    # Every measurement gets a fresh connection, objects can only be
+    # exported once per connection.
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_private_bus()
+    mainloop = GObject.MainLoop()
+    try:
+        client = dbus.bus.BusConnection(address)
+        print('%10s %14s %14s %16s' % ('attributes', 'eager (ms)',
+                                        'lazy (ms)', 'first call (ms)'))
+        for n in args.sizes:
+            schema = build_schema(n)
+            results = []
+            for build in (lambda bus: build_app(n, bus=bus),
+                          lambda bus: load_schema(bus, schema)):
+                bus = dbus.bus.BusConnection(address)
+                start = time.time()
+                app = build(bus)
+                results.append((time.time() - start) * 1e3)
+                bus.close()
+
+            # Exporting on demand moves the cost to the first call of
+            # each object instead, which goes through the LazyExporter.
+            bus = dbus.bus.BusConnection(address)
+            app = load_schema(bus, schema)
+            chrc = app.services[-1].characteristics[-1]
+            proxy = client.get_object(bus.get_unique_name(), chrc.path)
+            start = time.time()
+            value, = call_async(mainloop, proxy.ReadValue, {},
+                                dbus_interface=GATT_CHRC_IFACE)
+            results.append((time.time() - start) * 1e3)
+            if bytearray(value) != bytearray([100]) or chrc.bus is None:
+                raise RuntimeError('Lazy export of %s failed' % chrc.path)
+            bus.close()
+            print('%10d %14.1f %14.1f %16.3f' % tuple([n] + results))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def bench_hot_update(args):
+    # Every change is followed by a call to the mock, which returns once
+    # the mock has seen the signals or the new tree.
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_private_bus()
+    mock = spawn('mock_bluez.py', address)
+    mainloop = GObject.MainLoop()
+    try:
+        print('%10s %18s %16s %16s' % ('attributes', 're-register (ms)',
+                                        'hot add (ms)', 'hot remove (ms)'))
+        for n in args.sizes:
+            bus = dbus.bus.BusConnection(address)
+            if not wait_for(lambda: bus.name_has_owner(BLUEZ_SERVICE_NAME),
+                            10):
+                print('Mock BlueZ did not start')
+                return
+            adapter = bus.get_object(BLUEZ_SERVICE_NAME,
+                                     MockAdapter.PATH_BASE + '0')
+            manager = dbus.Interface(adapter, GATT_MANAGER_IFACE)
+            control = dbus.Interface(adapter, MOCK_CONTROL_IFACE)
+            app = build_app(n, bus=bus)
+            call_async(mainloop, manager.RegisterApplication,
+                       app.get_path(), {})
+
+            added = removed = 0.0
+            for i in range(args.number):
+                service = build_service(bus, free_index(app.services), 10)
+                start = time.time()
+                app.add_service(service)
+                call_async(mainloop, control.ListCharacteristics)
+                added += time.time() - start
+
+                start = time.time()
+                app.remove_service(service)
+                call_async(mainloop, control.ListCharacteristics)
+                removed += time.time() - start
+
+            reregister = 0.0
+            for i in range(args.number):
+                start = time.time()
+                call_async(mainloop, manager.UnregisterApplication,
+                           app.get_path())
+                call_async(mainloop, manager.RegisterApplication,
+                           app.get_path(), {})
+                call_async(mainloop, control.ListCharacteristics)
+                reregister += time.time() - start
+
+            call_async(mainloop, manager.UnregisterApplication,
+                       app.get_path())
+            bus.close()
+            print('%10d %18.2f %16.2f %16.2f' % (
+                    n, reregister / args.number * 1e3,
+                    added / args.number * 1e3, removed / args.number * 1e3))
+    finally:
+        mock.terminate()
+        mock.wait()
+        daemon.terminate()
+        daemon.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gatt_server benchmarks')
+    subparsers = parser.add_subparsers()
+
+    managed = subparsers.add_parser(
+            'managed-objects',
+            help='GetManagedObjects cost against attribute count')
+    managed.add_argument('--sizes', type=int, nargs='+',
+                         default=[10, 100, 300, 1000])
+    managed.add_argument('--number', type=int, default=100)
+    managed.set_defaults(func=bench_managed_objects)
+
+    encoding = subparsers.add_parser(
+            'value-encoding',
+            help='value encoding and marshalling cost against payload size')
+    encoding.add_argument('--sizes', type=int, nargs='+',
+                          default=[1, 16, 128, 512])
+    encoding.add_argument('--number', type=int, default=1000)
+    encoding.set_defaults(func=bench_value_encoding)
+
+    led_i2c = subparsers.add_parser(
+            'led-i2c',
+            help='LED board bus traffic on a simulated I2C bus')
+    led_i2c.add_argument('--frames', type=int, default=1000)
+    led_i2c.add_argument('--latency', type=float, default=0.0001,
+                         help='seconds per transaction')
+    led_i2c.add_argument('--byte-latency', type=float, default=0.00009,
+                         help='seconds per byte, about 100 kHz')
+    led_i2c.add_argument('--error-rate', type=float, default=0.0)
+    led_i2c.set_defaults(func=bench_led_i2c)
+
+    i2c_transaction = subparsers.add_parser(
+            'i2c-transaction',
+            help='separate block reads against one combined I2C transaction')
+    i2c_transaction.add_argument('--ranges', type=int, default=6)
+    i2c_transaction.add_argument('--length', type=int, default=16)
+    i2c_transaction.add_argument('--number', type=int, default=200)
+    i2c_transaction.add_argument('--latency', type=float, default=0.0001)
+    i2c_transaction.add_argument('--byte-latency', type=float,
+                                 default=0.00009)
+    i2c_transaction.set_defaults(func=bench_i2c_transaction)
+
+    schema_startup = subparsers.add_parser(
+            'schema-startup',
+            help='eager export against schema loading with lazy export')
+    schema_startup.add_argument('--sizes', type=int, nargs='+',
+                                default=[10, 100, 300, 1000])
+    schema_startup.set_defaults(func=bench_schema_startup)
+
+    hot_update = subparsers.add_parser(
+            'hot-update',
+            help='adding and removing a service at runtime against '
+                 're-registering the application')
+    hot_update.add_argument('--sizes', type=int, nargs='+',
+                            default=[10, 100, 300, 1000])
+    hot_update.add_argument('--number', type=int, default=20)
+    hot_update.set_defaults(func=bench_hot_update)
+
+    server = subparsers.add_parser(
+            'server',
+            help='GATT server throughput against a mock BlueZ on a private '
+                 'dbus-daemon')
+    server.add_argument('--servers', nargs='+',
+                        default=['battery.py', 'led.py'],
+                        help='server scripts, aio:<module> runs a server '
+                             'module on the asyncio backend')
+    server.add_argument('--concurrency', type=int, default=8)
+    server.add_argument('--count', type=int, default=2000)
+    server.add_argument('--timeout', type=float, default=10)
+    server.set_defaults(func=bench_server)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -3,28 +3,38 @@
 import dbus
 import dbus.exceptions
 import dbus.service
+import dbus.types
 import dbus.mainloop.glib
 
-import array
+import collections
+import errno
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import threading
 try:
   from gi.repository import GObject
 except ImportError:
   import gobject as GObject
 import sys
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 from random import randint
 
-BLUEZ_SERVICE_NAME = 'org.bluez'
-DBUS_OM_IFACE =      'org.freedesktop.DBus.ObjectManager'
-DBUS_PROP_IFACE =    'org.freedesktop.DBus.Properties'
+import gatt_core
+import gatt_log
+
+from gatt_core import *
 
-GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
-GATT_SERVICE_IFACE = 'org.bluez.GattService1'
-GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
-GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
+logger = logging.getLogger(__name__)
 
-LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
-LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+gatt_core.set_main_context(GObject)
 
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
@@ -41,23 +51,440 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
 class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+class PropertyReadOnlyException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.PropertyReadOnly'
+
+
+class AcquiredSocket(object):
+    """
+    Non-blocking SEQPACKET socket handed to BlueZ by AcquireWrite or
+    AcquireNotify, watched by the GLib main loop.
+
+    Every packet received is passed to read_cb as plain bytes and close_cb
+    is called once the peer hangs up.  Any connected socket works, so a
+    local socketpair can stand in for BlueZ.
+    """
+    def __init__(self, sock, mtu, read_cb=None, close_cb=None):
+        self.sock = sock
+        self.mtu = mtu
+        self.read_cb = read_cb
+        self.close_cb = close_cb
+        self.sock.setblocking(False)
+
+        condition = GObject.IO_HUP | GObject.IO_ERR
+        if read_cb is not None:
+            condition |= GObject.IO_IN
+        self.watch_id = GObject.io_add_watch(self.sock.fileno(), condition,
+                                             self.io_cb)
+
+    def io_cb(self, fd, condition):
+        if condition & GObject.IO_IN:
+            try:
+                data = self.sock.recv(self.mtu)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                data = b''
+            if data:
+                self.read_cb(data)
+                return True
+
+        self.watch_id = None
+        self.close()
+        return False
+
+    def send(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # Notifications are unacknowledged, a full socket
+                # buffer simply drops this value.
+                return 0
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.watch_id is not None:
+            GObject.source_remove(self.watch_id)
+            self.watch_id = None
+        self.sock.close()
+        self.sock = None
+        if self.close_cb is not None:
+            self.close_cb()
+
+
+def dump_stats_on_signal(path, signum=signal.SIGUSR1, stats=handler_stats):
+    def dump(*args):
+        stats.dump(path)
+        return True
+
+    try:
+        from gi.repository import GLib
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, dump)
+    except (ImportError, AttributeError):
+        # Plain Python handlers only run once the main loop calls back into
+        # Python, e.g. on the next D-Bus message or timer.
+        signal.signal(signum, dump)
+
+
+class StatsObject(dbus.service.Object):
+    """
+    Read-only D-Bus view of the handler statistics.
+
+    """
+    PATH = '/org/bluez/example/stats'
+
+    def __init__(self, bus, stats=handler_stats, adapters=None, workers=None):
+        self.path = self.PATH
+        self.stats = stats
+        self.adapters = adapters
+        self.workers = workers if workers is not None else {}
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(STATS_IFACE, out_signature='at')
+    def GetBuckets(self):
+        return dbus.Array(self.stats.buckets, signature='t')
+
+    @dbus.service.method(STATS_IFACE, out_signature='a{s(ttddat)}')
+    def GetStats(self):
+        stats = self.stats
+        result = {}
+        for index, name in enumerate(stats.names):
+            result[name] = dbus.Struct(
+                    (dbus.UInt64(stats.calls[index]),
+                     dbus.UInt64(stats.errors[index]),
+                     dbus.Double(stats.total_us[index]),
+                     dbus.Double(stats.max_us[index]),
+                     dbus.Array(stats.get_histogram(index), signature='t')),
+                    signature='ttddat')
+        return result
+
+    @dbus.service.method(STATS_IFACE, out_signature='s')
+    def GetJSON(self):
+        return self.stats.to_json()
+
+    @dbus.service.method(STATS_IFACE, out_signature='a{st}')
+    def GetTickStats(self):
+        return dbus.Dictionary(tick_scheduler.get_stats(), signature='st')
+
+    @dbus.service.method(STATS_IFACE, out_signature='a{sa{st}}')
+    def GetAdapterStats(self):
+        if self.adapters is None:
+            return dbus.Dictionary({}, signature='sa{st}')
+        return dbus.Dictionary(self.adapters.get_stats(),
+                               signature='sa{st}')
+
+    @dbus.service.method(STATS_IFACE, out_signature='a{sa{sd}}')
+    def GetWorkerStats(self):
+        return dbus.Dictionary(
+                dict((name, worker.getStats())
+                     for name, worker in self.workers.items()),
+                signature='sa{sd}')
+
+
+class LogControlObject(dbus.service.Object):
+    """
+    Changes per-module log levels of the running server.
+
+    """
+    PATH = '/org/bluez/example/log'
+
+    def __init__(self, bus):
+        self.path = self.PATH
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(LOG_IFACE, in_signature='ss')
+    def SetLevel(self, module, level):
+        try:
+            gatt_log.set_level(str(module), str(level))
+        except ValueError:
+            raise InvalidArgsException()
+
+    @dbus.service.method(LOG_IFACE, out_signature='a{ss}')
+    def GetLevels(self):
+        return gatt_log.get_levels()
+
+
+class ValueCodec(object):
+    """
+    Encodes characteristic values into a single dbus.ByteArray.
+
+    Values may be bytes, bytearray, memoryview, dbus.ByteArray or a
+    sequence of ints.  The last encoding is kept and handed out again
+    while the value stays byte-identical, so unchanged values are neither
+    copied nor turned into one Python object per byte.
+    """
+    def __init__(self):
+        self.encoded = None
+
+    def encode(self, value):
+        if isinstance(value, dbus.ByteArray):
+            self.encoded = value
+            return value
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        elif not isinstance(value, (bytes, bytearray)):
+            value = bytearray(value)
+
+        if self.encoded is not None and self.encoded == value:
+            return self.encoded
+        self.encoded = dbus.ByteArray(bytes(value))
+        return self.encoded
+
+
+def handler_error(error):
+    # Exceptions of offloaded handlers as the errors BlueZ expects
+    if isinstance(error, dbus.exceptions.DBusException):
+        return error
+    if (isinstance(error, EnvironmentError) and
+            error.errno in (errno.EACCES, errno.EPERM)):
+        return NotPermittedException(str(error))
+    return FailedException(str(error))
+
+
+class HandlerPool(object):
+    """
+    Bounded pool of worker threads for slow characteristic handlers.
+
+    Results and errors are passed back on the GLib main loop.  Handlers
+    run off the main loop and must not use D-Bus themselves.
+    """
+    def __init__(self, workers=4, maxsize=64):
+        self.maxsize = maxsize
+        self.requests = queue.Queue(maxsize)
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0,
+                      'rejected': 0}
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run,
+                                      name='gatt-handler-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, args, callback, error_handler):
+        try:
+            self.requests.put_nowait((func, args, callback, error_handler))
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['submitted'] += 1
+        return True
+
+    def run(self):
+        while True:
+            func, args, callback, error_handler = self.requests.get()
+            try:
+                result = func(*args)
+            except Exception as e:
+                GObject.idle_add(self.finish, 'failed', error_handler,
+                                 handler_error(e))
+            else:
+                GObject.idle_add(self.finish, 'completed', callback, result)
+
+    def finish(self, counter, callback, value):
+        self.stats[counter] += 1
+        callback(value)
+        return False
+
+
+handler_pool = None
+
+
+def get_handler_pool():
+    # Started on first use, servers without offloaded handlers get no
+    # extra threads.
+    global handler_pool
+    if handler_pool is None:
+        handler_pool = HandlerPool()
+    return handler_pool
+
+
+def init_object(obj, bus, path):
+    # dbus-python only takes a path together with a connection, objects
+    # built without one are exported later through add_to_connection.
+    dbus.service.Object.__init__(obj, bus, path if bus is not None else None)
+
+
+class PropertiesObject(dbus.service.Object):
+    """
+    org.freedesktop.DBus.Properties on top of build_properties().
+
+    The {interface: {name: value}} dict returned by build_properties() is
+    cached until invalidate_properties() is called.  Single values are
+    updated in place through update_property(), which keeps the dicts
+    handed out by GetManagedObjects current as well.
+
+    """
+    def __init__(self, bus, path):
+        self.properties = None
+        init_object(self, bus, path)
+
+    def build_properties(self):
+        return {}
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def invalidate_properties(self):
+        self.properties = None
+
+    def update_property(self, interface, name, value):
+        if self.properties is not None:
+            self.properties[interface][name] = value
+
+    def get_interface_properties(self, interface):
+        properties = self.get_properties()
+        if interface not in properties:
+            raise InvalidArgsException()
+        return properties[interface]
+
+    def set_property(self, interface, name, value):
+        # Override for writable properties
+        raise PropertyReadOnlyException()
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='ss',
+                         out_signature='v')
+    def Get(self, interface, name):
+        properties = self.get_interface_properties(interface)
+        if name not in properties:
+            raise InvalidArgsException()
+        return properties[name]
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        return self.get_interface_properties(interface)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if name not in self.get_interface_properties(interface):
+            raise InvalidArgsException()
+        self.set_property(interface, name, value)
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+def object_tree(obj):
+    # obj and everything below it, parents before their children
+    yield obj
+    for child in obj.get_children():
+        for descendant in object_tree(child):
+            yield descendant
+
+
+def free_index(objects):
+    return max([obj.index for obj in objects] or [-1]) + 1
+
+
+def unexport(obj):
+    if obj.bus is not None:
+        obj.remove_from_connection()
+        obj.bus = None
+
 
 class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.bus = bus
+        self.managed_objects = None
+        # Set once BlueZ has fetched the tree, later changes are announced
+        # through InterfacesAdded and InterfacesRemoved.
+        self.published = False
+        self.object_paths = None
+        self.exporter = None
+        self.notify_scheduler = NotificationScheduler()
+        init_object(self, bus, self.path)
+        if bus is not None:
+            bus.add_signal_receiver(self.device_properties_changed,
+                                    dbus_interface=DBUS_PROP_IFACE,
+                                    signal_name='PropertiesChanged',
+                                    arg0=DEVICE_IFACE,
+                                    bus_name=BLUEZ_SERVICE_NAME,
+                                    path_keyword='path')
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        service.app = self
         self.services.append(service)
-
-    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
+        self.objects_added(service)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        self.objects_removed(service)
+        service.app = None
+        for obj in reversed(list(object_tree(service))):
+            obj.release()
+
+    def objects_added(self, obj):
+        self.invalidate_managed_objects()
+        if not self.published:
+            return
+        for child in object_tree(obj):
+            self.InterfacesAdded(child.get_path(), child.get_properties())
+
+    def objects_removed(self, obj):
+        self.invalidate_managed_objects()
+        if not self.published:
+            return
+        for child in reversed(list(object_tree(obj))):
+            self.InterfacesRemoved(child.get_path(),
+                                   list(child.get_properties().keys()))
+
+    def device_properties_changed(self, interface, changed, invalidated,
+                                  path=None):
+        if changed.get('Connected', True):
+            return
+        logger.debug('%s disconnected', path)
+        self.device_disconnected(path)
+
+    def device_disconnected(self, device):
+        for service in self.services:
+            for chrc in service.get_characteristics():
+                chrc.drop_device(device)
+
+    def invalidate_managed_objects(self):
+        # Dropped whenever the object hierarchy changes, the next
+        # GetManagedObjects call rebuilds the tree once and caches it.
+        self.managed_objects = None
+        self.object_paths = None
+
+    def get_object(self, path):
+        if self.object_paths is None:
+            paths = {}
+            for service in self.services:
+                paths[service.path] = service
+                for chrc in service.get_characteristics():
+                    paths[chrc.path] = chrc
+                    for desc in chrc.get_descriptors():
+                        paths[desc.path] = desc
+            self.object_paths = paths
+        return self.object_paths.get(path)
+
+    def build_managed_objects(self):
         response = {}
-        print('GetManagedObjects')
 
         for service in self.services:
             response[service.get_path()] = service.get_properties()
@@ -70,19 +497,37 @@ class Application(dbus.service.Object):
 
         return response
 
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+
+        self.published = True
+        return self.managed_objects
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
 
-class Service(dbus.service.Object):
+class Service(PropertiesObject):
     PATH_BASE = '/org/bluez/example/service'
 
     def __init__(self, bus, index, uuid, primary):
         self.path = self.PATH_BASE + str(index)
+        self.index = index
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.app = None
+        PropertiesObject.__init__(self, bus, self.path)
 
-    def get_properties(self):
+    def build_properties(self):
         return {
                 GATT_SERVICE_IFACE: {
                         'UUID': self.uuid,
@@ -98,6 +543,30 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate_properties()
+        self.objects_added(characteristic)
+
+    def remove_characteristic(self, characteristic):
+        self.characteristics.remove(characteristic)
+        self.invalidate_properties()
+        self.objects_removed(characteristic)
+        for obj in reversed(list(object_tree(characteristic))):
+            obj.release()
+
+    def invalidate_managed_objects(self):
+        if self.app is not None:
+            self.app.invalidate_managed_objects()
+
+    def objects_added(self, obj):
+        if self.app is not None:
+            self.app.objects_added(obj)
+
+    def objects_removed(self, obj):
+        if self.app is not None:
+            self.app.objects_removed(obj)
+
+    def release(self):
+        unexport(self)
 
     def get_characteristic_paths(self):
         result = []
@@ -108,43 +577,89 @@ class Service(dbus.service.Object):
     def get_characteristics(self):
         return self.characteristics
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_SERVICE_IFACE:
-            raise InvalidArgsException()
+    def get_children(self):
+        return self.characteristics
 
-        return self.get_properties[GATT_SERVICE_IFACE]
 
+class Characteristic(CharacteristicMixin, PropertiesObject):
+    InvalidOffsetException = InvalidOffsetException
+    InvalidValueLengthException = InvalidValueLengthException
+    NotSupportedException = NotSupportedException
 
-class Characteristic(dbus.service.Object):
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + '/char' + str(index)
+        self.index = index
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
         self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        # Set to False in a subclass to opt in to AcquireWrite and
+        # AcquireNotify, None leaves the D-Bus only data path.
+        self.write_acquired = None
+        self.notify_acquired = None
+        self.write_sock = None
+        self.notify_sock = None
+        # Devices subscribed to notifications, None stands for the clients
+        # behind StartNotify or the acquired notify socket, which BlueZ does
+        # not tell apart.
+        self.subscribers = set()
+        # Per-device state, dropped when the device disconnects
+        self.sessions = {}
+        self.last_read = 0
+        # Maximum notifications per second, None sends every value
+        # immediately instead of through the application scheduler.
+        self.notify_rate = None
+        # Writes at a non-zero offset patch the last value of the device
+        # for values of a fixed value_length or up to max_value_length,
+        # otherwise they are rejected.
+        self.value_length = None
+        self.max_value_length = None
+        # Set offload to run read_value and write_value on the shared
+        # HandlerPool, max_concurrent limits how many of them run at once.
+        self.offload = False
+        self.max_concurrent = None
+        self.in_flight = 0
+        self.offload_queue = collections.deque()
+        self.codec = ValueCodec()
+        self.read_views = {}
+        self.write_buffers = {}
+        # Last value read or notified, exposed as the Value property, and
+        # the last value sent through PropertiesChanged.
+        self.cached_value = None
+        self.emitted_value = None
+        PropertiesObject.__init__(self, bus, self.path)
+
+    def build_properties(self):
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        if self.write_acquired is not None:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_acquired)
+        if self.notify_acquired is not None:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_acquired)
+        if self.cached_value is not None:
+            properties['Value'] = self.cached_value
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate_properties()
+        self.service.objects_added(descriptor)
+
+    def remove_descriptor(self, descriptor):
+        self.descriptors.remove(descriptor)
+        self.invalidate_properties()
+        self.service.objects_removed(descriptor)
+        descriptor.release()
 
     def get_descriptor_paths(self):
         result = []
@@ -155,86 +670,309 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_CHRC_IFACE:
-            raise InvalidArgsException()
+    def get_children(self):
+        return self.descriptors
 
-        return self.get_properties[GATT_CHRC_IFACE]
+    def release(self):
+        # Called once removed from the application, drops subscribers
+        # and sockets before the object is unexported.
+        if self.write_sock is not None:
+            self.write_sock.close()
+        if self.notify_sock is not None:
+            self.notify_sock.close()
+        for device in list(self.subscribers):
+            self.remove_subscriber(device)
+        for device in list(self.write_buffers):
+            self.drop_write_buffer(device)
+        unexport(self)
+
+    def set_acquired(self, write=None, notify=None):
+        if write is not None:
+            self.write_acquired = write
+        if notify is not None:
+            self.notify_acquired = notify
+        self.invalidate_properties()
+        self.service.invalidate_managed_objects()
+
+    def attach_write_socket(self, sock, mtu):
+        self.write_sock = AcquiredSocket(sock, mtu,
+                                         read_cb=self.acquired_write,
+                                         close_cb=self.release_write_socket)
+        self.set_acquired(write=True)
+
+    def release_write_socket(self):
+        self.write_sock = None
+        self.set_acquired(write=False)
+
+    def attach_notify_socket(self, sock, mtu):
+        # BlueZ acquires the socket for the first client and shares it with
+        # the later ones, it stays open until BlueZ hangs up.
+        self.add_subscriber(None)
+        self.notify_sock = AcquiredSocket(sock, mtu,
+                                          close_cb=self.release_notify_socket)
+        self.set_acquired(notify=True)
+
+    def release_notify_socket(self):
+        self.notify_sock = None
+        self.set_acquired(notify=False)
+        self.remove_subscriber(None)
+
+    def acquire_socket(self, options):
+        mtu = int(options.get('mtu', ATT_DEFAULT_MTU))
+        local, remote = socket.socketpair(socket.AF_UNIX,
+                                          socket.SOCK_SEQPACKET)
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        return local, fd, mtu
+
+    def acquired_write(self, data):
+        # Override for a fast path taking the raw bytes, by default the
+        # payload is handed to the regular write handler.
+        try:
+            self.write_value_async(bytearray(data), {},
+                                   self.write_done_cb, self.write_error_cb)
+        except dbus.exceptions.DBusException as e:
+            self.write_error_cb(e)
+
+    def read_value(self, options):
+        # Return bytes, bytearray, memoryview, dbus.ByteArray or a
+        # sequence of ints, see ValueCodec.
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def read_value_async(self, options, callback, error_handler):
+        # Override to produce the value off the main loop, the value is
+        # passed to callback once it is ready.
+        if self.offload:
+            self.run_offloaded(self.read_value, (options,), callback,
+                               error_handler)
+            return
+        callback(self.read_value(options))
+
+    def write_value(self, value, options):
+        logger.warning('Default WriteValue called, returning error')
+        raise NotSupportedException()
+
+    def write_value_async(self, value, options, reply_handler, error_handler):
+        if self.offload:
+            self.run_offloaded(self.write_value, (value, options),
+                               lambda result: reply_handler(), error_handler)
+            return
+        self.write_value(value, options)
+        reply_handler()
+
+    def run_offloaded(self, func, args, callback, error_handler):
+        pool = get_handler_pool()
+        if (self.max_concurrent is not None and
+                self.in_flight >= self.max_concurrent):
+            if len(self.offload_queue) >= pool.maxsize:
+                error_handler(FailedException('Handler queue full'))
+                return
+            self.offload_queue.append((func, args, callback, error_handler))
+            return
+
+        def done(result):
+            self.offload_done()
+            callback(result)
+
+        def failed(error):
+            self.offload_done()
+            error_handler(error)
+
+        self.in_flight += 1
+        if not pool.submit(func, args, done, failed):
+            self.in_flight -= 1
+            error_handler(FailedException('Handler queue full'))
+
+    def offload_done(self):
+        self.in_flight -= 1
+        if self.offload_queue:
+            self.run_offloaded(*self.offload_queue.popleft())
+
+    def add_subscriber(self, device=None):
+        # start_notify runs for the first subscriber only
+        if device in self.subscribers:
+            return
+        self.subscribers.add(device)
+        if len(self.subscribers) == 1:
+            try:
+                self.start_notify()
+            except Exception:
+                self.subscribers.discard(device)
+                raise
+
+    def remove_subscriber(self, device=None):
+        if device not in self.subscribers:
+            return
+        self.subscribers.discard(device)
+        if not self.subscribers:
+            self.cancel_notifications()
+            self.emitted_value = None
+            self.stop_notify()
+
+    def drop_device(self, device):
+        self.sessions.pop(device, None)
+        self.read_views.pop(device, None)
+        self.drop_write_buffer(device)
+        self.remove_subscriber(device)
+
+    def encode(self, value):
+        encoded = self.codec.encode(value)
+        self.cache_value(encoded)
+        return encoded
+
+    def wrap(self, data):
+        return dbus.ByteArray(data)
+
+    def cache_value(self, encoded):
+        if encoded is self.cached_value:
+            return
+        self.cached_value = encoded
+        self.update_property(GATT_CHRC_IFACE, 'Value', encoded)
+
+    def send_notification(self, value):
+        encoded = self.codec.encode(value)
+        self.cache_value(encoded)
+        if self.notify_sock is not None:
+            self.notify_sock.send(encoded)
+            return
+        # Subscribers already have this value
+        if encoded == self.emitted_value:
+            return
+        self.emitted_value = encoded
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': encoded }, [])
 
     @dbus.service.method(GATT_CHRC_IFACE,
                         in_signature='a{sv}',
-                        out_signature='ay')
-    def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
-        raise NotSupportedException()
+                        out_signature='ay',
+                        async_callbacks=('reply_handler', 'error_handler'))
+    def ReadValue(self, options, reply_handler, error_handler):
+        reply_handler, error_handler = handler_stats.timed_callbacks(
+                self.path + ':ReadValue', reply_handler, error_handler)
+        try:
+            self.read_request(options, reply_handler, error_handler)
+        except Exception as e:
+            error_handler(e)
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
-    def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise NotSupportedException()
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='aya{sv}',
+                        async_callbacks=('reply_handler', 'error_handler'),
+                        byte_arrays=True)
+    def WriteValue(self, value, options, reply_handler, error_handler):
+        reply_handler, error_handler = handler_stats.timed_callbacks(
+                self.path + ':WriteValue', reply_handler, error_handler)
+        try:
+            self.write_request(value, options, reply_handler, error_handler)
+        except Exception as e:
+            error_handler(e)
+
+    def acquire_write(self, options):
+        if self.write_acquired is None:
+            raise NotSupportedException()
+        if self.write_acquired:
+            raise NotPermittedException()
+
+        sock, fd, mtu = self.acquire_socket(options)
+        self.attach_write_socket(sock, mtu)
+        return fd, dbus.UInt16(mtu)
+
+    def acquire_notify(self, options):
+        if self.notify_acquired is None:
+            raise NotSupportedException()
+        if self.notify_acquired:
+            raise NotPermittedException()
+
+        sock, fd, mtu = self.acquire_socket(options)
+        try:
+            self.attach_notify_socket(sock, mtu)
+        except Exception:
+            sock.close()
+            raise
+        return fd, dbus.UInt16(mtu)
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
-        raise NotSupportedException()
+        handler_stats.call(self.path + ':StartNotify', self.add_subscriber)
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
-        raise NotSupportedException()
+        handler_stats.call(self.path + ':StopNotify', self.remove_subscriber)
 
-    @dbus.service.signal(DBUS_PROP_IFACE,
-                         signature='sa{sv}as')
-    def PropertiesChanged(self, interface, changed, invalidated):
-        pass
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireWrite(self, options):
+        return handler_stats.call(self.path + ':AcquireWrite',
+                                  self.acquire_write, options)
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='hq')
+    def AcquireNotify(self, options):
+        return handler_stats.call(self.path + ':AcquireNotify',
+                                  self.acquire_notify, options)
 
 
-class Descriptor(dbus.service.Object):
+class Descriptor(PropertiesObject):
     def __init__(self, bus, index, uuid, flags, characteristic):
         self.path = characteristic.path + '/desc' + str(index)
+        self.index = index
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.codec = ValueCodec()
+        self.cached_value = None
+        PropertiesObject.__init__(self, bus, self.path)
 
-    def get_properties(self):
-        return {
+    def build_properties(self):
+        properties = {
                 GATT_DESC_IFACE: {
                         'Characteristic': self.chrc.get_path(),
                         'UUID': self.uuid,
                         'Flags': self.flags,
                 }
         }
+        if self.cached_value is not None:
+            properties[GATT_DESC_IFACE]['Value'] = self.cached_value
+        return properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_DESC_IFACE:
-            raise InvalidArgsException()
+    def get_children(self):
+        return []
 
-        return self.get_properties[GATT_CHRC_IFACE]
+    def release(self):
+        unexport(self)
+
+    def read_value(self, options):
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def write_value(self, value, options):
+        logger.warning('Default WriteValue called, returning error')
+        raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
-        raise NotSupportedException()
-
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
+        value = handler_stats.call(self.path + ':ReadValue',
+                                   self.read_value, options)
+        encoded = self.codec.encode(value)
+        if encoded is not self.cached_value:
+            self.cached_value = encoded
+            self.update_property(GATT_DESC_IFACE, 'Value', encoded)
+        return encoded
+
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True)
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
-        raise NotSupportedException()
+        handler_stats.call(self.path + ':WriteValue',
+                           self.write_value, bytearray(value), options)
 
-class Advertisement(dbus.service.Object):
+class Advertisement(PropertiesObject):
     PATH_BASE = '/org/bluez/example/advertisement'
 
     def __init__(self, bus, index, advertising_type):
@@ -246,9 +984,9 @@ class Advertisement(dbus.service.Object):
         self.solicit_uuids = None
         self.service_data = None
         self.include_tx_power = None
-        dbus.service.Object.__init__(self, bus, self.path)
+        PropertiesObject.__init__(self, bus, self.path)
 
-    def get_properties(self):
+    def build_properties(self):
         properties = dict()
         properties['Type'] = self.ad_type
         if self.service_uuids is not None:
@@ -274,37 +1012,208 @@ class Advertisement(dbus.service.Object):
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_solicit_uuid(self, uuid):
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
             self.manufacturer_data = dict()
         self.manufacturer_data[manuf_code] = data
+        self.invalidate_properties()
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
             self.service_data = dict()
         self.service_data[uuid] = data
-
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        print 'GetAll'
-        if interface != LE_ADVERTISEMENT_IFACE:
-            raise InvalidArgsException()
-        print 'returning props'
-        return self.get_properties()[LE_ADVERTISEMENT_IFACE]
+        self.invalidate_properties()
 
     @dbus.service.method(LE_ADVERTISEMENT_IFACE,
                          in_signature='',
                          out_signature='')
     def Release(self):
-        print '%s: Released!' % self.path
+        logger.info('%s: Released!', self.path)
+
+
+class LazyExporter(dbus.service.FallbackObject):
+    """
+    Exports the objects of an application on the first message addressed
+    to them.
+
+    Registered as a fallback for the whole object tree, so a message for
+    an object that is not exported yet lands here.  The object is then
+    added to the connection under its own path, which takes precedence
+    from then on, and the message is dispatched to it.
+
+    """
+    PATH = '/org/bluez/example'
+
+    def __init__(self, bus, app):
+        self.app = app
+        self.exported = 0
+        dbus.service.FallbackObject.__init__(self, bus, self.PATH)
+
+    def _message_cb(self, connection, message):
+        obj = self.app.get_object(message.get_path())
+        if obj is None or obj.bus is not None:
+            return dbus.service.FallbackObject._message_cb(self, connection,
+                                                           message)
+        self.export(obj, connection)
+        return obj._message_cb(connection, message)
+
+    def export(self, obj, connection):
+        logger.debug('Exporting %s', obj.path)
+        obj.bus = connection
+        obj.add_to_connection(connection, obj.path)
+        self.exported += 1
+
+
+# Keys of a schema entry copied onto the characteristic as attributes
+SCHEMA_OPTIONS = ('value_length', 'max_value_length', 'notify_rate',
+                  'offload', 'max_concurrent')
+
+
+def resolve_handler(handler):
+    # Handlers are callables or 'module:name' strings, which lets JSON
+    # schemas refer to functions.
+    if handler is None or callable(handler):
+        return handler
+    module, _, name = handler.partition(':')
+    obj = importlib.import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def schema_value(value):
+    if value is None:
+        return None
+    if isinstance(value, type(u'')):
+        return bytearray(value.encode('utf-8'))
+    return bytearray(value)
+
+
+def is_writable(flags):
+    return any('write' in flag for flag in flags)
+
+
+class SchemaValueMixin(object):
+    """
+    Value handling of schema objects: the read and write handlers of the
+    entry are called with the object as first argument.  Without a read
+    handler the static value is returned, without a write handler writes
+    replace it.
+
+    """
+    def init_schema_value(self, entry):
+        self.value = schema_value(entry.get('value'))
+        self.read_handler = resolve_handler(entry.get('read'))
+        self.write_handler = resolve_handler(entry.get('write'))
+
+    def read_value(self, options):
+        if self.read_handler is not None:
+            return self.read_handler(self, options)
+        if self.value is None:
+            raise NotSupportedException()
+        return self.value
+
+    def write_value(self, value, options):
+        if self.write_handler is not None:
+            self.write_handler(self, value, options)
+        elif is_writable(self.flags):
+            self.value = bytearray(value)
+        else:
+            raise NotPermittedException()
+
+
+class SchemaCharacteristic(SchemaValueMixin, Characteristic):
+    """
+    Characteristic built from a schema entry.
+
+    The start_notify and stop_notify handlers are called with the
+    characteristic as first argument, like read and write.
+
+    """
+    def __init__(self, bus, index, service, entry):
+        Characteristic.__init__(self, bus, index, entry['uuid'],
+                                list(entry.get('flags', ['read'])), service)
+        self.init_schema_value(entry)
+        self.start_notify_handler = resolve_handler(entry.get('start_notify'))
+        self.stop_notify_handler = resolve_handler(entry.get('stop_notify'))
+        for option in SCHEMA_OPTIONS:
+            if option in entry:
+                setattr(self, option, entry[option])
+
+    def start_notify(self):
+        if self.start_notify_handler is not None:
+            self.start_notify_handler(self)
+
+    def stop_notify(self):
+        if self.stop_notify_handler is not None:
+            self.stop_notify_handler(self)
+
+
+class SchemaDescriptor(SchemaValueMixin, Descriptor):
+    def __init__(self, bus, index, characteristic, entry):
+        Descriptor.__init__(self, bus, index, entry['uuid'],
+                            list(entry.get('flags', ['read'])),
+                            characteristic)
+        self.init_schema_value(entry)
+
+
+def load_schema(bus, schema, app=None):
+    """
+    Builds or extends an Application from a declarative schema, a dict or
+    its JSON text:
+
+        {"services": [
+            {"uuid": "180f", "primary": true, "characteristics": [
+                {"uuid": "2a19", "flags": ["read", "notify"],
+                 "read": "battery_handlers:read_level", "notify_rate": 1,
+                 "descriptors": [
+                     {"uuid": "2901", "value": "Battery level"}]}]}]}
+
+    Object paths follow the position in the schema.  An entry with a
+    "class" key is built by calling it as class(None, index[, service])
+    instead.  Only the application is exported up front, everything else
+    is exported through a LazyExporter once BlueZ first calls it.
+
+    """
+    if not isinstance(schema, dict):
+        schema = json.loads(schema)
+    if app is None:
+        app = Application(bus)
+
+    for service_entry in schema.get('services', []):
+        index = free_index(app.services)
+        cls = resolve_handler(service_entry.get('class'))
+        if cls is not None:
+            service = cls(None, index)
+        else:
+            service = Service(None, index, service_entry['uuid'],
+                              service_entry.get('primary', True))
+        app.add_service(service)
+
+        for chrc_entry in service_entry.get('characteristics', []):
+            index = free_index(service.characteristics)
+            cls = resolve_handler(chrc_entry.get('class'))
+            if cls is not None:
+                chrc = cls(None, index, service)
+            else:
+                chrc = SchemaCharacteristic(None, index, service, chrc_entry)
+            service.add_characteristic(chrc)
+
+            for desc_entry in chrc_entry.get('descriptors', []):
+                chrc.add_descriptor(SchemaDescriptor(
+                        None, free_index(chrc.descriptors), chrc, desc_entry))
+
+    if bus is not None and app.exporter is None:
+        app.exporter = LazyExporter(bus, app)
+    return app
 
 def find_manager(bus, iface):
     remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
@@ -331,3 +1240,235 @@ def find_gatt_interface(bus, obj):
 
 def find_ad_interface(bus, obj):
     return find_interface(bus, obj, LE_ADVERTISING_MANAGER_IFACE)
+
+def find_adapters(bus):
+    # Every adapter offering GattManager1, with its properties
+    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                               DBUS_OM_IFACE)
+    objects = remote_om.GetManagedObjects()
+
+    return sorted([(o, props) for o, props in objects.items()
+                   if GATT_MANAGER_IFACE in props], key=lambda item: item[0])
+
+
+# Consecutive registration failures after which an adapter is skipped
+MAX_ADAPTER_FAILURES = 3
+
+PLACEMENT_POLICIES = ('all', 'first', 'round-robin', 'least-loaded')
+
+
+class Adapter(object):
+    """
+    A BlueZ adapter with the health and load counters used for placement.
+
+    """
+    def __init__(self, bus, path, properties=None):
+        self.path = str(path)
+        adapter = (properties or {}).get(ADAPTER_IFACE, {})
+        self.address = str(adapter.get('Address', ''))
+        self.powered = bool(adapter.get('Powered', True))
+        self.props = find_interface(bus, path, DBUS_PROP_IFACE)
+        self.gatt_manager = find_gatt_interface(bus, path)
+        self.ad_manager = find_ad_interface(bus, path)
+        self.applications = []
+        self.advertisements = []
+        self.connections = set()
+        self.registrations = 0
+        self.errors = 0
+        self.failures = 0
+
+    def is_healthy(self):
+        return self.powered and self.failures < MAX_ADAPTER_FAILURES
+
+    def load(self):
+        return (len(self.connections),
+                len(self.applications) + len(self.advertisements))
+
+    def power_on(self):
+        # An adapter that refuses, e.g. rfkill-blocked or unplugged, stays
+        # out of placement until BlueZ reports it powered.
+        try:
+            self.props.Set(ADAPTER_IFACE, 'Powered', dbus.Boolean(1))
+        except dbus.exceptions.DBusException as e:
+            logger.warning('%s: Failed to power on: %s', self.path, e)
+            self.errors += 1
+            self.failures += 1
+            self.powered = False
+            return False
+        self.powered = True
+        return True
+
+    def register(self, method, path, records, reply_handler, error_handler):
+        def reply_cb():
+            self.registrations += 1
+            self.failures = 0
+            records.append(path)
+            reply_handler()
+
+        def error_cb(error):
+            self.errors += 1
+            self.failures += 1
+            error_handler(error)
+
+        method(path, {}, reply_handler=reply_cb, error_handler=error_cb)
+
+    def register_application(self, app, reply_handler, error_handler):
+        self.register(self.gatt_manager.RegisterApplication, app.get_path(),
+                      self.applications, reply_handler, error_handler)
+
+    def register_advertisement(self, ad, reply_handler, error_handler):
+        self.register(self.ad_manager.RegisterAdvertisement, ad.get_path(),
+                      self.advertisements, reply_handler, error_handler)
+
+    def get_stats(self):
+        return {
+                'powered': int(self.powered),
+                'healthy': int(self.is_healthy()),
+                'connections': len(self.connections),
+                'applications': len(self.applications),
+                'advertisements': len(self.advertisements),
+                'registrations': self.registrations,
+                'errors': self.errors,
+        }
+
+
+class AdapterPool(object):
+    """
+    Spreads applications and advertisements over all local adapters.
+
+    With the 'all' policy everything is registered with every adapter,
+    'first', 'round-robin' and 'least-loaded' pick a single adapter and
+    fall back to the next one if registration fails.  An advertisement
+    passed along with an application is registered wherever the
+    application was placed.  The policy defaults
+    to the GATT_PLACEMENT environment variable, or 'all'.  Connected
+    devices and the Powered property are followed for every adapter, so
+    load and health stay current.
+
+    """
+    def __init__(self, bus, policy=None):
+        if policy is None:
+            policy = os.environ.get('GATT_PLACEMENT', 'all')
+        if policy not in PLACEMENT_POLICIES:
+            raise ValueError('Unknown placement policy %r' % policy)
+        self.policy = policy
+        self.next_index = 0
+        self.adapters = [Adapter(bus, path, props)
+                         for path, props in find_adapters(bus)]
+        bus.add_signal_receiver(self.properties_changed,
+                                dbus_interface=DBUS_PROP_IFACE,
+                                signal_name='PropertiesChanged',
+                                bus_name=BLUEZ_SERVICE_NAME,
+                                path_keyword='path')
+
+    def get_adapter(self, path):
+        for adapter in self.adapters:
+            if path == adapter.path or path.startswith(adapter.path + '/'):
+                return adapter
+        return None
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        adapter = self.get_adapter(str(path))
+        if adapter is None:
+            return
+        if interface == ADAPTER_IFACE and 'Powered' in changed:
+            adapter.powered = bool(changed['Powered'])
+            logger.info('%s powered %s', adapter.path,
+                        'on' if adapter.powered else 'off')
+        elif interface == DEVICE_IFACE and 'Connected' in changed:
+            if changed['Connected']:
+                adapter.connections.add(str(path))
+            else:
+                adapter.connections.discard(str(path))
+            logger.debug('%s: %d connections', adapter.path,
+                         len(adapter.connections))
+
+    def power_on(self):
+        for adapter in self.adapters:
+            adapter.power_on()
+
+    def candidates(self):
+        healthy = [a for a in self.adapters if a.is_healthy()]
+        if self.policy == 'round-robin' and healthy:
+            start = self.next_index % len(healthy)
+            self.next_index += 1
+            return healthy[start:] + healthy[:start]
+        if self.policy == 'least-loaded':
+            return sorted(healthy, key=lambda a: a.load())
+        return healthy
+
+    def place(self, method, obj, reply_handler=None, error_handler=None):
+        # reply_handler is called with every adapter that took obj,
+        # error_handler once if none did.
+        candidates = self.candidates()
+        if not candidates:
+            if error_handler is not None:
+                error_handler(FailedException('No usable adapter'))
+            return
+        if self.policy == 'all':
+            chains = [[adapter] for adapter in candidates]
+        else:
+            chains = [candidates]
+        state = {'pending': len(chains), 'placed': 0}
+
+        def finished(error=None):
+            state['pending'] -= 1
+            if error is None:
+                state['placed'] += 1
+            if state['pending'] or state['placed']:
+                return
+            if error_handler is not None:
+                error_handler(error)
+
+        def attempt(chain, error):
+            if not chain:
+                finished(error)
+                return
+            adapter = chain[0]
+
+            def reply_cb():
+                logger.info('%s registered with %s', obj.get_path(),
+                            adapter.path)
+                if reply_handler is not None:
+                    reply_handler(adapter)
+                finished()
+
+            def error_cb(e):
+                logger.warning('%s: %s failed: %s', adapter.path, method, e)
+                attempt(chain[1:], e)
+
+            getattr(adapter, method)(obj, reply_cb, error_cb)
+
+        for chain in chains:
+            attempt(chain, None)
+
+    def register_application(self, app, reply_handler=None,
+                             error_handler=None, advertisement=None):
+        # The advertisement follows the application to every adapter that
+        # took it, so centrals connect where the services are.
+        def placed_cb(adapter):
+            if advertisement is not None:
+                self.advertise(adapter, advertisement)
+            if reply_handler is not None:
+                reply_handler(adapter)
+
+        self.place('register_application', app, placed_cb, error_handler)
+
+    def advertise(self, adapter, ad):
+        def reply_cb():
+            logger.info('%s registered with %s', ad.get_path(), adapter.path)
+
+        def error_cb(error):
+            logger.error('%s: Failed to register advertisement: %s',
+                         adapter.path, error)
+
+        adapter.register_advertisement(ad, reply_cb, error_cb)
+
+    def register_advertisement(self, ad, reply_handler=None,
+                               error_handler=None):
+        self.place('register_advertisement', ad, reply_handler,
+                   error_handler)
+
+    def get_stats(self):
+        return dict((adapter.path, adapter.get_stats())
+                    for adapter in self.adapters)
@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+
+"""
+asyncio backend for the GATT server, on top of dbus-next instead of
+dbus-python and GLib.
+
+It provides the Application, Service, Characteristic, Descriptor and
+Advertisement model of gatt with the same constructors and handler hooks.
+read_value, write_value, start_notify and stop_notify may also be written
+as coroutines.  GObject is replaced by the same source API on the asyncio
+loop, so server modules written against gatt run unchanged:
+
+    python3 gatt_aio.py battery
+
+AcquireWrite and AcquireNotify are not offered, BlueZ then uses ReadValue,
+WriteValue and PropertiesChanged for every characteristic.
+"""
+
+import argparse
+import asyncio
+import importlib
+import inspect
+import itertools
+import logging
+import sys
+import time
+
+from dbus_next import BusType, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.errors import DBusError
+from dbus_next.service import (ServiceInterface, PropertyAccess,
+                               dbus_property, method)
+
+import gatt_core
+import gatt_log
+
+from gatt_core import *
+
+logger = logging.getLogger(__name__)
+
+
+class BluezError(DBusError):
+    error_name = 'org.bluez.Error.Failed'
+
+    def __init__(self, text=''):
+        DBusError.__init__(self, self.error_name, text)
+
+class InvalidArgsException(BluezError):
+    error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+class NotSupportedException(BluezError):
+    error_name = 'org.bluez.Error.NotSupported'
+
+class NotPermittedException(BluezError):
+    error_name = 'org.bluez.Error.NotPermitted'
+
+class InvalidValueLengthException(BluezError):
+    error_name = 'org.bluez.Error.InvalidValueLength'
+
+class FailedException(BluezError):
+    error_name = 'org.bluez.Error.Failed'
+
+class InvalidOffsetException(BluezError):
+    error_name = 'org.bluez.Error.InvalidOffset'
+
+
+class AsyncioSources(object):
+    """
+    The part of the GLib source API used by the servers, run on an asyncio
+    loop.
+
+    Callbacks are called again for as long as they return True, like GLib
+    sources.  idle_add may be called from any thread.
+    """
+    PRIORITY_DEFAULT = 0
+
+    class MainLoop(object):
+        def run(self):
+            GObject.get_loop().run_forever()
+
+        def quit(self):
+            GObject.get_loop().stop()
+
+    def __init__(self):
+        self.loop = None
+        self.handles = {}
+        self.ids = itertools.count(1)
+
+    def attach(self, loop):
+        self.loop = loop
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+    def schedule(self, source_id, delay, callback, args):
+        def run():
+            if callback(*args) and source_id in self.handles:
+                self.schedule(source_id, delay, callback, args)
+            else:
+                self.handles.pop(source_id, None)
+
+        self.handles[source_id] = self.get_loop().call_later(delay, run)
+
+    def timeout_add(self, interval, callback, *args):
+        source_id = next(self.ids)
+        self.schedule(source_id, interval / 1000.0, callback, args)
+        return source_id
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        return self.timeout_add(interval * 1000, callback, *args)
+
+    def idle_add(self, callback, *args):
+        source_id = next(self.ids)
+        self.get_loop().call_soon_threadsafe(self.schedule, source_id, 0,
+                                             callback, args)
+        return source_id
+
+    def source_remove(self, source_id):
+        handle = self.handles.pop(source_id, None)
+        if handle is not None:
+            handle.cancel()
+        return handle is not None
+
+    def threads_init(self):
+        pass
+
+
+GObject = AsyncioSources()
+gatt_core.set_main_context(GObject)
+
+
+def unwrap(options):
+    return dict((key, value.value) for key, value in options.items())
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return bytes(bytearray(value))
+
+
+async def call_hook(func, *args):
+    # Handler hooks may be plain functions or coroutines
+    result = func(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def complete(result, callback, error_handler):
+    if not inspect.isawaitable(result):
+        callback(result)
+        return
+
+    def done(future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            error_handler(future.exception())
+        else:
+            callback(future.result())
+
+    asyncio.ensure_future(result).add_done_callback(done)
+
+
+async def timed(name, awaitable):
+    start = time.time()
+    try:
+        result = await awaitable
+    except Exception:
+        handler_stats.record(name, time.time() - start, True)
+        raise
+    handler_stats.record(name, time.time() - start)
+    return result
+
+
+async def call(bus, path, interface, member, signature='', body=()):
+    reply = await bus.call(Message(destination=BLUEZ_SERVICE_NAME,
+                                   path=path,
+                                   interface=interface,
+                                   member=member,
+                                   signature=signature,
+                                   body=list(body)))
+    if reply.message_type == MessageType.ERROR:
+        raise DBusError(reply.error_name,
+                        reply.body[0] if reply.body else '')
+    return reply.body
+
+
+class Application(object):
+    def __init__(self, bus):
+        self.path = '/'
+        self.bus = bus
+        self.services = []
+        self.notify_scheduler = NotificationScheduler()
+        # GetManagedObjects is answered by dbus-next from the exports
+        if bus is not None:
+            bus.add_message_handler(self.message_cb)
+
+    def get_path(self):
+        return self.path
+
+    def add_service(self, service):
+        service.app = self
+        self.services.append(service)
+
+    async def watch_devices(self):
+        await self.bus.call(Message(
+                destination='org.freedesktop.DBus',
+                path='/org/freedesktop/DBus',
+                interface='org.freedesktop.DBus',
+                member='AddMatch',
+                signature='s',
+                body=["type='signal',sender='%s',interface='%s',"
+                      "member='PropertiesChanged',arg0='%s'" % (
+                              BLUEZ_SERVICE_NAME, DBUS_PROP_IFACE,
+                              DEVICE_IFACE)]))
+
+    def message_cb(self, msg):
+        if (msg.message_type != MessageType.SIGNAL or
+                msg.interface != DBUS_PROP_IFACE or
+                msg.member != 'PropertiesChanged' or
+                msg.body[0] != DEVICE_IFACE):
+            return
+        connected = msg.body[1].get('Connected')
+        if connected is not None and not connected.value:
+            logger.debug('%s disconnected', msg.path)
+            self.device_disconnected(msg.path)
+
+    def device_disconnected(self, device):
+        for service in self.services:
+            for chrc in service.get_characteristics():
+                chrc.drop_device(device)
+
+
+class Service(ServiceInterface):
+    PATH_BASE = '/org/bluez/example/service'
+
+    def __init__(self, bus, index, uuid, primary):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.app = None
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        if bus is not None:
+            bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+
+    def get_characteristic_paths(self):
+        return [chrc.get_path() for chrc in self.characteristics]
+
+    def get_characteristics(self):
+        return self.characteristics
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> 'b':
+        return self.primary
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> 'ao':
+        return self.get_characteristic_paths()
+
+
+class Characteristic(CharacteristicMixin, ServiceInterface):
+    InvalidOffsetException = InvalidOffsetException
+    InvalidValueLengthException = InvalidValueLengthException
+    NotSupportedException = NotSupportedException
+
+    def __init__(self, bus, index, uuid, flags, service):
+        self.path = service.path + '/char' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        # Accepted for compatibility with gatt, no sockets are handed out.
+        self.write_acquired = None
+        self.notify_acquired = None
+        self.subscribers = set()
+        self.sessions = {}
+        self.last_read = 0
+        self.notify_rate = None
+        self.value_length = None
+        self.max_value_length = None
+        self.value = b''
+        self.emitted_value = None
+        self.read_views = {}
+        self.write_buffers = {}
+        ServiceInterface.__init__(self, GATT_CHRC_IFACE)
+        if bus is not None:
+            bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+
+    def get_descriptor_paths(self):
+        return [desc.get_path() for desc in self.descriptors]
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    def read_value(self, options):
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def read_value_async(self, options, callback, error_handler):
+        complete(self.read_value(options), callback, error_handler)
+
+    def write_value(self, value, options):
+        logger.warning('Default WriteValue called, returning error')
+        raise NotSupportedException()
+
+    def write_value_async(self, value, options, reply_handler, error_handler):
+        complete(self.write_value(value, options),
+                 lambda result: reply_handler(), error_handler)
+
+    def encode(self, value):
+        return encode_value(value)
+
+    async def request(self, name, func, *args):
+        # Runs a callback style handler and waits for its reply
+        future = asyncio.get_event_loop().create_future()
+
+        def reply(*result):
+            if not future.done():
+                future.set_result(result[0] if result else None)
+
+        def error(e):
+            if not future.done():
+                future.set_exception(e)
+
+        reply, error = handler_stats.timed_callbacks(self.path + name,
+                                                     reply, error)
+        try:
+            func(*(args + (reply, error)))
+        except Exception as e:
+            error(e)
+        return await future
+
+    async def add_subscriber(self, device=None):
+        if device in self.subscribers:
+            return
+        self.subscribers.add(device)
+        if len(self.subscribers) == 1:
+            try:
+                await call_hook(self.start_notify)
+            except Exception:
+                self.subscribers.discard(device)
+                raise
+
+    async def remove_subscriber(self, device=None):
+        if device not in self.subscribers:
+            return
+        self.subscribers.discard(device)
+        if not self.subscribers:
+            self.cancel_notifications()
+            self.emitted_value = None
+            await call_hook(self.stop_notify)
+
+    def drop_device(self, device):
+        self.sessions.pop(device, None)
+        self.read_views.pop(device, None)
+        self.drop_write_buffer(device)
+        if device in self.subscribers:
+            asyncio.ensure_future(self.remove_subscriber(device))
+
+    def send_notification(self, value):
+        value = encode_value(value)
+        # Subscribers already have this value
+        if value == self.emitted_value:
+            return
+        self.value = self.emitted_value = value
+        self.emit_properties_changed({'Value': self.value})
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> 'o':
+        return self.service.get_path()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return self.flags
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> 'ao':
+        return self.get_descriptor_paths()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> 'ay':
+        return self.value
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return await self.request(':ReadValue', self.read_request,
+                                  unwrap(options))
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await self.request(':WriteValue', self.write_request, value,
+                           unwrap(options))
+
+    @method()
+    async def StartNotify(self):
+        await timed(self.path + ':StartNotify', self.add_subscriber())
+
+    @method()
+    async def StopNotify(self):
+        await timed(self.path + ':StopNotify', self.remove_subscriber())
+
+
+class Descriptor(ServiceInterface):
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        self.path = characteristic.path + '/desc' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+        ServiceInterface.__init__(self, GATT_DESC_IFACE)
+        if bus is not None:
+            bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def read_value(self, options):
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def write_value(self, value, options):
+        logger.warning('Default WriteValue called, returning error')
+        raise NotSupportedException()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> 'o':
+        return self.chrc.get_path()
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return self.flags
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        value = await timed(self.path + ':ReadValue',
+                            call_hook(self.read_value, unwrap(options)))
+        return encode_value(value)
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await timed(self.path + ':WriteValue',
+                    call_hook(self.write_value, bytearray(value),
+                              unwrap(options)))
+
+
+class Advertisement(ServiceInterface):
+    PATH_BASE = '/org/bluez/example/advertisement'
+
+    def __init__(self, bus, index, advertising_type):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.ad_type = advertising_type
+        self.service_uuids = None
+        self.manufacturer_data = None
+        self.solicit_uuids = None
+        self.service_data = None
+        self.include_tx_power = None
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        if bus is not None:
+            bus.export(self.path, self)
+
+    def get_path(self):
+        return self.path
+
+    def add_service_uuid(self, uuid):
+        if not self.service_uuids:
+            self.service_uuids = []
+        self.service_uuids.append(uuid)
+
+    def add_solicit_uuid(self, uuid):
+        if not self.solicit_uuids:
+            self.solicit_uuids = []
+        self.solicit_uuids.append(uuid)
+
+    def add_manufacturer_data(self, manuf_code, data):
+        if not self.manufacturer_data:
+            self.manufacturer_data = dict()
+        self.manufacturer_data[manuf_code] = data
+
+    def add_service_data(self, uuid, data):
+        if not self.service_data:
+            self.service_data = dict()
+        self.service_data[uuid] = data
+
+    # Unset properties are sent empty, which BlueZ treats as absent
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> 's':
+        return self.ad_type
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceUUIDs(self) -> 'as':
+        return self.service_uuids or []
+
+    @dbus_property(access=PropertyAccess.READ)
+    def SolicitUUIDs(self) -> 'as':
+        return self.solicit_uuids or []
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ManufacturerData(self) -> 'a{qv}':
+        return dict((code, Variant('ay', encode_value(data)))
+                    for code, data in (self.manufacturer_data or {}).items())
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceData(self) -> 'a{sv}':
+        return dict((uuid, Variant('ay', encode_value(data)))
+                    for uuid, data in (self.service_data or {}).items())
+
+    @dbus_property(access=PropertyAccess.READ)
+    def IncludeTxPower(self) -> 'b':
+        return bool(self.include_tx_power)
+
+    @method()
+    def Release(self):
+        logger.info('%s: Released!', self.path)
+
+
+async def find_manager(bus, iface):
+    objects = (await call(bus, '/', DBUS_OM_IFACE, 'GetManagedObjects'))[0]
+    for path, interfaces in objects.items():
+        if iface in interfaces:
+            return path
+    return None
+
+async def find_gatt_manager(bus):
+    return await find_manager(bus, GATT_MANAGER_IFACE)
+
+async def find_ad_manager(bus):
+    return await find_manager(bus, LE_ADVERTISING_MANAGER_IFACE)
+
+
+def load_server(name):
+    """
+    Imports a server module written against gatt, with this module
+    standing in for gatt.
+
+    """
+    sys.modules['gatt'] = sys.modules[__name__]
+    return importlib.import_module(name)
+
+
+def defined_in(module, base):
+    return [obj for obj in vars(module).values()
+            if isinstance(obj, type) and issubclass(obj, base) and
+            obj.__module__ == module.__name__]
+
+
+async def serve(module):
+    """
+    Registers the services of a server module and every Advertisement
+    subclass with the first adapter.  The services come from the module's
+    create_services(bus) when it has one, so options its main() passes
+    apply here too, otherwise every Service subclass is built with its
+    default arguments.
+
+    """
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+    ad_man = await find_ad_manager(bus)
+    if not ad_man:
+        logger.error('LEAdvertisingManager1 interface not found')
+        return
+    await call(bus, ad_man, DBUS_PROP_IFACE, 'Set', 'ssv',
+               [ADAPTER_IFACE, 'Powered', Variant('b', True)])
+
+    gatt_man = await find_gatt_manager(bus)
+    if not gatt_man:
+        logger.error('GattManager1 interface not found')
+        return
+
+    app = Application(bus)
+    create_services = getattr(module, 'create_services', None)
+    if create_services is not None:
+        services = create_services(bus)
+    else:
+        services = [cls(bus, index)
+                    for index, cls in enumerate(defined_in(module, Service))]
+    for service in services:
+        app.add_service(service)
+    await app.watch_devices()
+
+    for index, cls in enumerate(defined_in(module, Advertisement)):
+        advertisement = cls(bus, index)
+        await call(bus, ad_man, LE_ADVERTISING_MANAGER_IFACE,
+                   'RegisterAdvertisement', 'oa{sv}',
+                   [advertisement.get_path(), {}])
+        logger.info('Advertisement registered')
+
+    await call(bus, gatt_man, GATT_MANAGER_IFACE, 'RegisterApplication',
+               'oa{sv}', [app.get_path(), {}])
+    logger.info('GATT application registered')
+
+    await bus.wait_for_disconnect()
+
+
+def exception_handler(loop, context):
+    # dbus-next raises handler errors again after replying with them
+    if isinstance(context.get('exception'), DBusError):
+        return
+    loop.default_exception_handler(context)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Runs a GATT server module on the asyncio backend')
+    parser.add_argument('module', help='server module, e.g. battery or led')
+    args = parser.parse_args()
+
+    gatt_log.setup_logging()
+    loop = asyncio.new_event_loop()
+    loop.set_exception_handler(exception_handler)
+    asyncio.set_event_loop(loop)
+    GObject.attach(loop)
+    module = load_server(args.module)
+    try:
+        loop.run_until_complete(serve(module))
+    except DBusError as e:
+        logger.error('Failed to register: %s', e)
+
+if __name__ == '__main__':
+    # Run through the importable module, so server modules share it
+    import gatt_aio
+    gatt_aio.main()
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+
+"""
+Backend-neutral parts of the GATT server: BlueZ names, ATT limits, handler
+statistics and the notification and tick schedulers.
+
+The schedulers run their timers through the GLib-style source API of the
+main context set with set_main_context(), gatt installs GObject and
+gatt_aio its asyncio equivalent.
+"""
+
+import array
+import json
+import logging
+import math
+import time
+
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+main_context = None
+
+
+def set_main_context(context):
+    global main_context
+    main_context = context
+
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+DBUS_OM_IFACE =      'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE =    'org.freedesktop.DBus.Properties'
+
+ADAPTER_IFACE =      'org.bluez.Adapter1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+GATT_SERVICE_IFACE = 'org.bluez.GattService1'
+GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
+GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
+DEVICE_IFACE =       'org.bluez.Device1'
+
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+
+STATS_IFACE = 'org.bluez.example.GattStats1'
+LOG_IFACE = 'org.bluez.example.GattLog1'
+
+ATT_DEFAULT_MTU = 23
+# Longest attribute value a client can read or write.
+ATT_MAX_VALUE_LENGTH = 512
+
+
+# Upper bounds of the handler latency buckets in microseconds, one more
+# bucket collects everything slower.
+LATENCY_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000,
+                      100000)
+
+
+class HandlerStats(object):
+    """
+    Call and error counters with fixed-bucket latency histograms, one slot
+    per handler name, kept in flat arrays.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS_US):
+        self.buckets = buckets
+        self.width = len(buckets) + 1
+        self.names = []
+        self.slots = {}
+        self.calls = array.array('L')
+        self.errors = array.array('L')
+        self.total_us = array.array('d')
+        self.max_us = array.array('d')
+        self.histograms = array.array('L')
+
+    def slot(self, name):
+        index = self.slots.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self.slots[name] = index
+            self.calls.append(0)
+            self.errors.append(0)
+            self.total_us.append(0.0)
+            self.max_us.append(0.0)
+            self.histograms.extend([0] * self.width)
+        return index
+
+    def record(self, name, seconds, failed=False):
+        index = self.slot(name)
+        us = seconds * 1e6
+        self.calls[index] += 1
+        if failed:
+            self.errors[index] += 1
+        self.total_us[index] += us
+        if us > self.max_us[index]:
+            self.max_us[index] = us
+        self.histograms[index * self.width +
+                        bisect_left(self.buckets, us)] += 1
+
+    def call(self, name, func, *args):
+        start = time.time()
+        try:
+            result = func(*args)
+        except Exception:
+            self.record(name, time.time() - start, True)
+            raise
+        self.record(name, time.time() - start)
+        return result
+
+    def timed_callbacks(self, name, reply_handler, error_handler):
+        # Wraps the callbacks of an asynchronous handler, the latency is
+        # taken when the reply is sent.
+        start = time.time()
+
+        def reply(*args):
+            self.record(name, time.time() - start)
+            reply_handler(*args)
+
+        def error(e):
+            self.record(name, time.time() - start, True)
+            error_handler(e)
+
+        return reply, error
+
+    def get_histogram(self, index):
+        start = index * self.width
+        return self.histograms[start:start + self.width].tolist()
+
+    def get_stats(self):
+        stats = {}
+        for index, name in enumerate(self.names):
+            stats[name] = {
+                    'calls': self.calls[index],
+                    'errors': self.errors[index],
+                    'total_us': self.total_us[index],
+                    'max_us': self.max_us[index],
+                    'histogram': self.get_histogram(index),
+            }
+        return stats
+
+    def to_json(self):
+        return json.dumps({'buckets_us': list(self.buckets),
+                           'handlers': self.get_stats()}, sort_keys=True)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+
+handler_stats = HandlerStats()
+
+
+class NotificationScheduler(object):
+    """
+    Coalesces value notifications per characteristic.
+
+    Only the latest value scheduled for a characteristic is kept.  Pending
+    values are sent from a single one-shot GLib timer, armed for the
+    earliest time the characteristic's notify_rate allows the next one.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.last_sent = {}
+        self.timer_id = None
+        self.timer_due = None
+        self.stats = {}
+
+    def get_counters(self, chrc):
+        path = chrc.path
+        if path not in self.stats:
+            self.stats[path] = {'sent': 0, 'coalesced': 0, 'dropped': 0}
+        return self.stats[path]
+
+    def get_due(self, chrc):
+        # A notify_rate of zero or less does not limit the rate
+        if chrc.notify_rate <= 0:
+            return 0
+        return self.last_sent.get(chrc, 0) + 1.0 / chrc.notify_rate
+
+    def arm(self, now):
+        if not self.pending:
+            return
+        due = min(self.get_due(chrc) for chrc in self.pending)
+        if self.timer_id is not None:
+            if due >= self.timer_due:
+                return
+            main_context.source_remove(self.timer_id)
+        self.timer_due = due
+        self.timer_id = main_context.timeout_add(
+                max(0, int(math.ceil((due - now) * 1000))), self.flush_cb)
+
+    def schedule(self, chrc, value):
+        if chrc in self.pending:
+            self.get_counters(chrc)['coalesced'] += 1
+        self.pending[chrc] = value
+        self.arm(time.time())
+
+    def cancel(self, chrc):
+        if self.pending.pop(chrc, None) is not None:
+            self.get_counters(chrc)['dropped'] += 1
+
+    def send(self, chrc, value, now):
+        counters = self.get_counters(chrc)
+        if not chrc.is_notifying():
+            counters['dropped'] += 1
+            return
+        chrc.send_notification(value)
+        counters['sent'] += 1
+        self.last_sent[chrc] = now
+
+    def flush(self):
+        if self.timer_id is not None:
+            main_context.source_remove(self.timer_id)
+            self.timer_id = None
+        now = time.time()
+        for chrc, value in list(self.pending.items()):
+            self.send(chrc, value, now)
+        self.pending.clear()
+
+    def flush_cb(self):
+        self.timer_id = None
+        now = time.time()
+        for chrc, value in list(self.pending.items()):
+            if now < self.get_due(chrc):
+                continue
+            del self.pending[chrc]
+            self.send(chrc, value, now)
+        self.arm(now)
+        return False
+
+    def get_stats(self):
+        totals = {'sent': 0, 'coalesced': 0, 'dropped': 0}
+        for counters in self.stats.values():
+            for key in totals:
+                totals[key] += counters[key]
+        return {'total': totals, 'characteristics': self.stats}
+
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+class TickScheduler(object):
+    """
+    Runs periodic tasks from one shared GLib timer.
+
+    Periods are whole seconds and the timer ticks at their greatest common
+    divisor, so tasks with related periods run on the same wakeup.  The
+    timer is a timeout_add_seconds source, which GLib also aligns with the
+    other second-granularity timers of the process.  A task tied to a
+    characteristic is skipped while nobody is subscribed to it and it was
+    not read for idle_after seconds.
+    """
+    def __init__(self, idle_after=30):
+        self.idle_after = idle_after
+        # task id -> [period, callback, chrc, next due time]
+        self.tasks = {}
+        self.next_id = 1
+        self.tick = 0
+        self.timer_id = None
+        self.elapsed = 0
+        self.stats = {'wakeups': 0, 'runs': 0, 'paused': 0, 'errors': 0}
+
+    def add(self, period, callback, chrc=None):
+        """
+        Calls callback every period seconds until it returns False or the
+        task is removed, returns the task id.
+
+        """
+        period = max(1, int(round(period)))
+        task_id = self.next_id
+        self.next_id += 1
+        self.tasks[task_id] = [period, callback, chrc, self.elapsed + period]
+        self.rearm()
+        return task_id
+
+    def remove(self, task_id):
+        if self.tasks.pop(task_id, None) is not None:
+            self.rearm()
+
+    def rearm(self):
+        tick = 0
+        for task in self.tasks.values():
+            tick = gcd(tick, task[0])
+        if tick == self.tick:
+            return
+        if self.timer_id is not None:
+            main_context.source_remove(self.timer_id)
+            self.timer_id = None
+        self.tick = tick
+        if tick:
+            self.timer_id = main_context.timeout_add_seconds(tick,
+                                                             self.tick_cb)
+
+    def is_active(self, chrc):
+        if chrc.is_notifying():
+            return True
+        return time.time() - chrc.last_read < self.idle_after
+
+    def tick_cb(self):
+        timer_id = self.timer_id
+        self.elapsed += self.tick
+        self.stats['wakeups'] += 1
+        for task_id, task in list(self.tasks.items()):
+            period, callback, chrc, due = task
+            if due > self.elapsed or task_id not in self.tasks:
+                continue
+            task[3] = self.elapsed + period
+            if chrc is not None and not self.is_active(chrc):
+                self.stats['paused'] += 1
+                continue
+            self.stats['runs'] += 1
+            try:
+                keep = callback()
+            except Exception:
+                # An exception would end the shared timer and with it every
+                # other task, a failing task is kept and tried again.
+                logger.exception('Periodic task %d failed', task_id)
+                self.stats['errors'] += 1
+                keep = True
+            if not keep:
+                self.remove(task_id)
+        # Adding or removing tasks may have replaced the timer
+        return self.timer_id == timer_id
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        # With a timer per task every run, paused or not, is a wakeup
+        stats['saved'] = max(0, stats['runs'] + stats['paused'] -
+                                stats['wakeups'])
+        stats['tasks'] = len(self.tasks)
+        return stats
+
+
+tick_scheduler = TickScheduler()
+
+
+class CharacteristicMixin(object):
+    """
+    Characteristic behaviour shared by the backends: sessions, notification
+    scheduling, default hooks and Read Blob and long write handling.
+
+    A read sequence is served from one encoded value per device, Read Blob
+    requests are sliced from it.  BlueZ merges the Prepare Write requests
+    of a long write and delivers them on Execute Write, so a write at
+    offset 0 is always a whole value and goes straight to
+    write_value_async.  A write at another offset patches the last value
+    written by the same device and hands the result on the same way.  The
+    backend provides encode() for its value type, send_notification() and
+    the exceptions to raise.
+    """
+    InvalidOffsetException = None
+    InvalidValueLengthException = None
+    NotSupportedException = None
+
+    def is_notifying(self):
+        return bool(self.subscribers)
+
+    def get_session(self, device):
+        if device not in self.sessions:
+            self.sessions[device] = {}
+        return self.sessions[device]
+
+    def get_notify_scheduler(self):
+        if self.notify_rate is None or self.service.app is None:
+            return None
+        return self.service.app.notify_scheduler
+
+    def notify_value(self, value):
+        if not self.is_notifying():
+            return
+        scheduler = self.get_notify_scheduler()
+        if scheduler is not None:
+            scheduler.schedule(self, value)
+            return
+        self.send_notification(value)
+
+    def cancel_notifications(self):
+        scheduler = self.get_notify_scheduler()
+        if scheduler is not None:
+            scheduler.cancel(self)
+
+    def write_done_cb(self):
+        pass
+
+    def write_error_cb(self, error):
+        logger.error('Write to %s failed: %s', self.path, error)
+
+    def start_notify(self):
+        # Called when the first device subscribes
+        logger.warning('Default StartNotify called, returning error')
+        raise self.NotSupportedException()
+
+    def stop_notify(self):
+        # Called when the last device unsubscribes or disconnects
+        logger.warning('Default StopNotify called, returning error')
+        raise self.NotSupportedException()
+
+    def wrap(self, data):
+        return data
+
+    def slice_value(self, encoded, view, options):
+        offset = int(options.get('offset', 0))
+        if offset > len(view):
+            raise self.InvalidOffsetException()
+        end = len(view)
+        if 'mtu' in options:
+            # A Read Blob response holds at most mtu - 1 bytes
+            end = min(end, offset + int(options['mtu']) - 1)
+        if offset == 0 and end == len(view):
+            return encoded
+        return self.wrap(view[offset:end].tobytes())
+
+    def read_done(self, device, value, options, reply_handler,
+                  error_handler):
+        # The value is serialized once per read sequence, the following
+        # Read Blob requests are sliced from the same buffer.
+        encoded = self.encode(value)
+        view = memoryview(encoded)
+        self.read_views[device] = (encoded, view)
+        try:
+            reply_handler(self.slice_value(encoded, view, options))
+        except self.InvalidOffsetException as e:
+            error_handler(e)
+
+    def read_request(self, options, reply_handler, error_handler):
+        self.last_read = time.time()
+        device = options.get('device')
+        cached = self.read_views.get(device)
+        if int(options.get('offset', 0)) and cached is not None:
+            reply_handler(self.slice_value(cached[0], cached[1], options))
+            return
+
+        self.read_value_async(
+                options,
+                lambda value: self.read_done(device, value, options,
+                                             reply_handler, error_handler),
+                error_handler)
+
+    def drop_write_buffer(self, device):
+        self.write_buffers.pop(device, None)
+
+    def write_request(self, value, options, reply_handler, error_handler):
+        # Values are handed on as a bytearray, indexing gives ints on every
+        # Python version.
+        value = bytearray(value)
+        offset = int(options.get('offset', 0))
+        device = options.get('device')
+        limit = self.value_length or self.max_value_length
+        if offset:
+            base = self.write_buffers.get(device)
+            if limit is None or base is None or offset > len(base):
+                raise self.InvalidOffsetException()
+            value = base[:offset] + value
+            options = dict(options)
+            options.pop('offset')
+        if limit is not None and len(value) > limit:
+            raise self.InvalidValueLengthException()
+        if self.value_length is not None and len(value) != self.value_length:
+            raise self.InvalidValueLengthException()
+        if limit is None:
+            self.write_value_async(value, options, reply_handler,
+                                   error_handler)
+            return
+
+        def done():
+            # Kept for writes at an offset, only once the handler took it
+            self.write_buffers[device] = value
+            reply_handler()
+
+        self.drop_write_buffer(device)
+        self.write_value_async(value, options, done, error_handler)
@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import collections
+import logging
+import os
+import sys
+import threading
+
+# Levels used when nothing else is configured, modules log through
+# logging.getLogger(__name__).
+DEFAULT_LEVELS = {
+        'gatt': logging.INFO,
+        'gatt_aio': logging.INFO,
+        'gatt_core': logging.INFO,
+        'battery': logging.INFO,
+        'led': logging.INFO,
+        'adafruit_i2c': logging.INFO,
+}
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Queues log records in a bounded in-memory ring and writes them from a
+    background thread.
+
+    Records are formatted on the writer thread, so the logging call itself
+    only appends to a deque.  Arguments are formatted late and should not
+    be mutated after the call.  When the ring is full the oldest records
+    are overwritten and counted in dropped.
+    """
+    def __init__(self, stream=None, capacity=4096, interval=0.25):
+        logging.Handler.__init__(self)
+        self.stream = stream if stream is not None else sys.stderr
+        self.records = collections.deque(maxlen=capacity)
+        self.interval = interval
+        self.dropped = 0
+        # The handler lock is held by logging.shutdown() while it calls
+        # close(), which joins the writer, so the writer uses its own lock.
+        self.write_lock = threading.Lock()
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record)
+
+    def write_pending(self):
+        with self.write_lock:
+            written = False
+            while self.records:
+                record = self.records.popleft()
+                try:
+                    self.stream.write(self.format(record) + '\n')
+                except Exception:
+                    self.handleError(record)
+                written = True
+            if written:
+                self.stream.flush()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.write_pending()
+
+    def flush(self):
+        self.write_pending()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.write_pending()
+        logging.Handler.close(self)
+
+
+def parse_levels(spec):
+    "Parses 'module=level,...' into a dict, e.g. 'gatt=debug,led=warning'"
+    levels = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip()
+    return levels
+
+
+def set_level(name, level):
+    "Changes the verbosity of one module, usable at any time"
+    if not isinstance(level, int):
+        level = logging.getLevelName(str(level).upper())
+        if not isinstance(level, int):
+            raise ValueError('Unknown log level for %s' % name)
+    logging.getLogger(name).setLevel(level)
+
+
+def get_levels():
+    levels = {}
+    for name in sorted(set(DEFAULT_LEVELS) |
+                       set(logging.Logger.manager.loggerDict)):
+        level = logging.getLogger(name).getEffectiveLevel()
+        levels[name] = logging.getLevelName(level)
+    return levels
+
+
+def setup_logging(levels=None, stream=None, capacity=4096):
+    """
+    Installs a RingBufferHandler on the root logger and applies the module
+    levels, by default taken from the GATT_LOG environment variable.
+    """
+    handler = RingBufferHandler(stream, capacity)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING)
+
+    for name, level in DEFAULT_LEVELS.items():
+        set_level(name, level)
+    if levels is None:
+        levels = parse_levels(os.environ.get('GATT_LOG', ''))
+    for name, level in levels.items():
+        set_level(name, level)
+    return handler
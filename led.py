@@ -1,11 +1,68 @@
 #!/usr/bin/python
 
+import struct
+import time
+
 from gatt import *
+from gatt_log import setup_logging
+
+from adafruit_i2c import Adafruit_I2C, Adafruit_I2CWorker
 
-from adafruit_i2c import Adafruit_I2C
+logger = logging.getLogger(__name__)
 
 mainloop = None
 
+FRAME_SIZE = 16
+
+# Animation program: header (type, interval in ms, repeat count with 0
+# repeating forever) followed by raw frames or one base frame for effects.
+ANIMATION_HEADER = struct.Struct('<BHB')
+# As many raw frames as fit in one attribute value
+MAX_ANIMATION_FRAMES = ((ATT_MAX_VALUE_LENGTH - ANIMATION_HEADER.size) //
+                        FRAME_SIZE)
+ANIMATION_STOP = 0x00
+ANIMATION_FRAMES = 0x01
+ANIMATION_BLINK = 0x02
+ANIMATION_SCROLL = 0x03
+ANIMATION_WIPE = 0x04
+
+
+def render_animation(kind, payload, out):
+    """
+    Renders the frames of an animation program into out, returns the
+    number of frames.
+
+    """
+    if kind == ANIMATION_FRAMES:
+        count = len(payload) // FRAME_SIZE
+        if (not payload or len(payload) % FRAME_SIZE or
+                count > MAX_ANIMATION_FRAMES):
+            raise InvalidValueLengthException()
+        out[:len(payload)] = payload
+        return count
+
+    if len(payload) != FRAME_SIZE:
+        raise InvalidValueLengthException()
+    if kind == ANIMATION_BLINK:
+        out[:FRAME_SIZE] = payload
+        out[FRAME_SIZE:2 * FRAME_SIZE] = bytearray(FRAME_SIZE)
+        return 2
+    if kind == ANIMATION_SCROLL:
+        for step in range(8):
+            offset = step * FRAME_SIZE
+            for i, b in enumerate(payload):
+                out[offset + i] = ((b << step) | (b >> (8 - step))) & 0xff
+        return 8
+    if kind == ANIMATION_WIPE:
+        for step in range(FRAME_SIZE):
+            offset = step * FRAME_SIZE
+            out[offset:offset + step + 1] = payload[:step + 1]
+            out[offset + step + 1:offset + FRAME_SIZE] = \
+                    bytearray(FRAME_SIZE - step - 1)
+        return FRAME_SIZE
+    raise InvalidArgsException()
+
+
 class LEDAdvertisement(Advertisement):
 
     def __init__(self, bus, index):
@@ -23,9 +80,13 @@ class LEDService(Service):
     """
     LED_UUID = '180f' #battery
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, write_behind=False):
         Service.__init__(self, bus, index, self.LED_UUID, True)
-        self.add_characteristic(LEDBoardCharacteristic(bus, 0, self))
+        self.board = LEDBoardCharacteristic(bus, 0, self,
+                                            write_behind=write_behind)
+        self.add_characteristic(self.board)
+        self.add_characteristic(LEDAnimationCharacteristic(bus, 1, self,
+                                                           self.board))
 
 class LEDBoardCharacteristic(Characteristic):
     """
@@ -34,91 +95,291 @@ class LEDBoardCharacteristic(Characteristic):
     """
     LED_BOARD_UUID = '2a19' #battery_level
 
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, write_behind=False,
+                 max_frame_rate=30):
         self.led_list = []
-        self.i2cbus = Adafruit_I2C(address=114, busnum=1, debug=True)
+        self.i2cbus = Adafruit_I2C(address=114, busnum=1, debug=True,
+                                   shadow=True)
         self.i2cbus.readList(00, 16)
+        # All bus access after startup runs on the worker thread, replies
+        # are sent from the main loop.
+        self.i2c_worker = Adafruit_I2CWorker(dispatch=GObject.idle_add,
+                                             observer=self.i2c_observer)
         Characteristic.__init__(
                 self, bus, index,
                 self.LED_BOARD_UUID,
-                ['read', 'write'],
+                ['read', 'write', 'write-without-response'],
                 service)
+        self.write_acquired = False
+        self.value_length = 16
+        # In write-behind mode writes are acknowledged at once and only the
+        # latest frame is pushed to the board, at most max_frame_rate
+        # times per second.
+        self.write_behind = write_behind
+        self.max_frame_rate = max_frame_rate
+        self.pending_frame = None
+        self.frame_in_flight = False
+        self.flush_timer = None
+        self.last_flush = 0
+        self.frame_stats = {'received': 0, 'written': 0, 'skipped': 0,
+                            'failed': 0}
+
+    def i2c_observer(self, name, seconds, failed):
+        handler_stats.record('i2c:0x%02X:%s' % (self.i2cbus.address, name),
+                             seconds, failed)
 
     def ReadLEDList(self):
-        self.led_list = self.i2cbus.readList(00, 16)
+        result = self.i2cbus.readList(00, 16)
+        if result != -1:
+            self.led_list = result
+        return result
+
+    def WriteLEDList(self, frame):
+        # Only the registers that changed since the last frame hit the bus,
+        # see i2cbus.deltaStats for the bytes saved. The frame is passed in
+        # since a later write may arrive before this one reaches the worker.
+        result = self.i2cbus.writeListDelta(00, frame)
+        if result != -1:
+            self.led_list = list(frame)
+        return result
+
+    def submit(self, func, args, callback, error_handler):
+        def done(result):
+            if result == -1:
+                error_handler(FailedException('I2C transaction failed'))
+            else:
+                callback(result)
+
+        def failed(error):
+            error_handler(FailedException(str(error)))
+
+        if not self.i2c_worker.submit(func, args, done, failed):
+            error_handler(FailedException('I2C queue full'))
+
+    def queue_frame(self, frame):
+        self.frame_stats['received'] += 1
+        if self.pending_frame is not None:
+            self.frame_stats['skipped'] += 1
+        self.pending_frame = frame
+        if self.flush_timer is None and not self.frame_in_flight:
+            delay = self.last_flush + 1.0 / self.max_frame_rate - time.time()
+            self.flush_timer = GObject.timeout_add(
+                    max(0, int(delay * 1000)), self.flush_timer_cb)
+
+    def flush_timer_cb(self):
+        self.flush_timer = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """
+        Pushes the pending frame to the board now, unless a frame is still
+        being written, in which case it follows as soon as that is done.
+
+        """
+        if self.flush_timer is not None:
+            GObject.source_remove(self.flush_timer)
+            self.flush_timer = None
+        if self.pending_frame is None or self.frame_in_flight:
+            return
+
+        frame = self.pending_frame
+        self.pending_frame = None
+        self.last_flush = time.time()
+        self.frame_in_flight = True
+        if not self.i2c_worker.submit(self.WriteLEDList, (frame,),
+                                      self.frame_written_cb,
+                                      self.frame_written_cb):
+            self.frame_written_cb(-1)
+
+    def frame_written_cb(self, result):
+        self.frame_in_flight = False
+        if result == -1 or isinstance(result, Exception):
+            self.frame_stats['failed'] += 1
+        else:
+            self.frame_stats['written'] += 1
+        if self.pending_frame is not None:
+            self.queue_frame(self.pending_frame)
+            # Re-queueing is not a new frame from the client
+            self.frame_stats['received'] -= 1
+            self.frame_stats['skipped'] -= 1
+
+    def read_value_async(self, options, callback, error_handler):
+        if self.pending_frame is not None:
+            callback(self.pending_frame)
+            return
+
+        def done(result):
+            logger.debug('LEDBoardCharacteristic read: %r', self.led_list)
+            callback(self.led_list)
+
+        self.submit(self.ReadLEDList, (), done, error_handler)
+
+    def write_value_async(self, value, options, reply_handler, error_handler):
+        # Offset writes are merged by Characteristic, value_length makes
+        # sure only whole frames arrive here.
+        logger.debug('LEDBoardCharacteristic Write: %r', value)
+        if self.write_behind:
+            self.queue_frame(value)
+            reply_handler()
+            return
+        self.submit(self.WriteLEDList, (value,),
+                    lambda result: reply_handler(), error_handler)
+
+    def acquired_write(self, data):
+        if len(data) != 16:
+            logger.warning('LEDBoardCharacteristic acquired write of wrong length')
+            return
+        if self.write_behind:
+            self.queue_frame(bytearray(data))
+            return
+        self.i2c_worker.submit(self.WriteLEDList, (list(bytearray(data)),))
+
+
+class LEDAnimationCharacteristic(Characteristic):
+    """
+    Plays animation programs on the LED board from one GLib timer.
 
-    def WriteLEDList(self):
-        self.i2cbus.writeList(00, self.led_list)
+    A program is rendered once into the back frame buffer and swapped in
+    on the next tick, so the running animation is never torn.  Writing a
+    single ANIMATION_STOP byte stops playback.
 
-    def ReadValue(self, options):
-        self.ReadLEDList()
-        print('LEDBoardCharacteristic read: ' + repr(self.led_list))
-        return [dbus.Byte(x) for x in self.led_list]
+    """
+    LED_ANIMATION_UUID = '12345678-1234-5678-1234-56789abc1f00'
 
-    def WriteValue(self, value, options):
-        print('LEDBoardCharacteristic Write: ' + repr(value))
-        if len(value) != 16:
+    def __init__(self, bus, index, service, board):
+        Characteristic.__init__(
+                self, bus, index,
+                self.LED_ANIMATION_UUID,
+                ['read', 'write'],
+                service)
+        self.board = board
+        self.program = bytearray([ANIMATION_STOP])
+        self.max_value_length = (ANIMATION_HEADER.size +
+                                 MAX_ANIMATION_FRAMES * FRAME_SIZE)
+        self.buffers = [bytearray(MAX_ANIMATION_FRAMES * FRAME_SIZE)
+                        for i in range(2)]
+        self.front = 0
+        # (frame count, interval, repeat) of the back buffer until swapped
+        self.back = None
+        self.frame_count = 0
+        self.interval = 0
+        self.repeat = 0
+        self.position = 0
+        self.loops = 0
+        self.timer = None
+
+    def read_value(self, options):
+        return self.program
+
+    def write_value(self, value, options):
+        if len(value) == 1 and value[0] == ANIMATION_STOP:
+            self.stop()
+            self.program = bytearray(value)
+            return
+        if len(value) < ANIMATION_HEADER.size:
             raise InvalidValueLengthException()
-        self.led_list = value
-        self.WriteLEDList()
 
-def register_app_cb():
-    print('GATT application registered')
+        kind, interval, repeat = ANIMATION_HEADER.unpack_from(bytes(value))
+        back = self.buffers[1 - self.front]
+        count = render_animation(kind, value[ANIMATION_HEADER.size:], back)
+        # Frames faster than the board accepts would only be skipped
+        interval = max(interval, int(1000 / self.board.max_frame_rate))
+        self.back = (count, interval, repeat)
+        self.program = bytearray(value)
+        logger.debug('LEDAnimationCharacteristic program: %d frames every '
+                     '%d ms', count, interval)
+        if self.timer is None:
+            self.timer = GObject.timeout_add(interval, self.tick)
+            self.tick()
+
+    def stop(self):
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+            self.timer = None
+        self.back = None
+        self.frame_count = 0
+
+    def swap(self):
+        self.front = 1 - self.front
+        self.frame_count, interval, self.repeat = self.back
+        self.back = None
+        self.position = 0
+        self.loops = 0
+        if interval == self.interval:
+            return True
+        self.interval = interval
+        GObject.source_remove(self.timer)
+        self.timer = GObject.timeout_add(interval, self.tick)
+        return False
+
+    def tick(self):
+        keep = True
+        if self.back is not None:
+            keep = self.swap()
+
+        offset = self.position * FRAME_SIZE
+        self.board.queue_frame(
+                self.buffers[self.front][offset:offset + FRAME_SIZE])
+        self.position += 1
+        if self.position == self.frame_count:
+            self.position = 0
+            self.loops += 1
+            if self.repeat and self.loops >= self.repeat:
+                self.stop()
+                return False
+        return keep
+
+def register_app_cb(adapter):
+    logger.info('GATT application registered with %s', adapter.path)
 
 
 def register_app_error_cb(error):
-    print('Failed to register application: ' + str(error))
+    logger.error('Failed to register application: %s', error)
     mainloop.quit()
 
-def register_ad_cb():
-    print 'Advertisement registered'
-
-
-def register_ad_error_cb(error):
-    print 'Failed to register advertisement: ' + str(error)
-    mainloop.quit()
+def create_services(bus):
+    "Returns the services of this server, gatt_aio runs them the same way"
+    return [LEDService(bus, 0, write_behind=True)]
 
 def main():
     global mainloop
 
+    setup_logging()
+    GObject.threads_init()
+    dbus.mainloop.glib.threads_init()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     bus = dbus.SystemBus()
 
-    ad_man = find_ad_manager(bus)
-    if not ad_man:
-        print 'LEAdvertisingManager1 interface not found'
+    adapters = AdapterPool(bus)
+    if not adapters.adapters:
+        logger.error('No adapter with GattManager1 found')
         return
 
-    ad_man_props = find_interface(bus, ad_man, "org.freedesktop.DBus.Properties")
-
-    ad_man_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-
-    ad_manager = find_ad_interface(bus, ad_man)
+    adapters.power_on()
 
     led_advertisement = LEDAdvertisement(bus, 0)
 
-
-    gatt_man = find_gatt_manager(bus)
-    if not gatt_man:
-        print('GattManager1 interface not found')
-        return
-
-    service_manager = find_gatt_interface(bus, gatt_man)
-
     app = Application(bus)
 
-    app.add_service(LEDService(bus, 0))
+    services = create_services(bus)
+    for service in services:
+        app.add_service(service)
 
-    mainloop = GObject.MainLoop()
+    board = services[0].board
+    StatsObject(bus, adapters=adapters,
+                workers={'i2c:0x%02X' % board.i2cbus.address:
+                         board.i2c_worker})
+    LogControlObject(bus)
+    dump_stats_on_signal('/tmp/led_gatt_stats.json')
 
-    ad_manager.RegisterAdvertisement(led_advertisement.get_path(), {},
-                                     reply_handler=register_ad_cb,
-                                     error_handler=register_ad_error_cb)
+    mainloop = GObject.MainLoop()
 
-    service_manager.RegisterApplication(app.get_path(), {},
-                                    reply_handler=register_app_cb,
-                                    error_handler=register_app_error_cb)
+    adapters.register_application(app,
+                                  reply_handler=register_app_cb,
+                                  error_handler=register_app_error_cb,
+                                  advertisement=led_advertisement)
 
     mainloop.run()
 
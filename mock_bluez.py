@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+"""
+Minimal stand-in for the org.bluez service, for running the GATT servers
+without Bluetooth hardware.
+
+It claims org.bluez on the system bus (point DBUS_SYSTEM_BUS_ADDRESS at a
+private dbus-daemon) and exposes one adapter with GattManager1 and
+LEAdvertisingManager1, so find_gatt_manager/find_ad_manager resolve as
+usual.  Registered applications are fetched through GetManagedObjects
+like BlueZ does, kept up to date through InterfacesAdded and
+InterfacesRemoved, and can be listed through org.bluez.mock.Control1.
+"""
+
+import logging
+
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+
+from gatt import *
+from gatt_log import setup_logging
+
+logger = logging.getLogger(__name__)
+
+MOCK_CONTROL_IFACE = 'org.bluez.mock.Control1'
+
+
+class MockObjectManager(dbus.service.Object):
+    def __init__(self, bus, adapters):
+        self.adapters = adapters
+        dbus.service.Object.__init__(self, bus, '/')
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        response = {}
+        for adapter in self.adapters:
+            response[adapter.get_path()] = adapter.get_properties()
+        return response
+
+
+class MockAdapter(dbus.service.Object):
+    PATH_BASE = '/org/bluez/hci'
+
+    def __init__(self, bus, index):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.address = '00:00:00:00:00:%02X' % index
+        self.powered = False
+        self.applications = {}
+        self.watches = {}
+        self.advertisements = {}
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def get_properties(self):
+        return {
+                ADAPTER_IFACE: {
+                        'Address': self.address,
+                        'Powered': dbus.Boolean(self.powered),
+                },
+                GATT_MANAGER_IFACE: {},
+                LE_ADVERTISING_MANAGER_IFACE: {},
+        }
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='ss',
+                         out_signature='v')
+    def Get(self, interface, prop):
+        properties = self.get_properties().get(interface, {})
+        if prop not in properties:
+            raise InvalidArgsException()
+        return properties[prop]
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        return self.get_properties().get(interface, {})
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, prop, value):
+        if interface != ADAPTER_IFACE or prop != 'Powered':
+            raise NotPermittedException()
+        self.powered = bool(value)
+
+    @dbus.service.method(GATT_MANAGER_IFACE,
+                         in_signature='oa{sv}',
+                         sender_keyword='sender',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def RegisterApplication(self, path, options, sender=None,
+                            reply_handler=None, error_handler=None):
+        key = (str(sender), str(path))
+        if key in self.applications:
+            raise InvalidArgsException()
+
+        def objects_cb(objects):
+            self.applications[key] = dict(objects)
+            self.watch_application(key)
+            logger.info('%s: registered application %s%s (%d objects)',
+                        self.path, sender, path, len(objects))
+            reply_handler()
+
+        def objects_error_cb(error):
+            error_handler(FailedException(str(error)))
+
+        om = dbus.Interface(self.bus.get_object(sender, path), DBUS_OM_IFACE)
+        om.GetManagedObjects(reply_handler=objects_cb,
+                             error_handler=objects_error_cb)
+
+    @dbus.service.method(GATT_MANAGER_IFACE,
+                         in_signature='o',
+                         sender_keyword='sender')
+    def UnregisterApplication(self, path, sender=None):
+        key = (str(sender), str(path))
+        if self.applications.pop(key, None) is None:
+            raise InvalidArgsException()
+        for match in self.watches.pop(key):
+            match.remove()
+
+    def watch_application(self, key):
+        sender, path = key
+        objects = self.applications[key]
+
+        def added_cb(obj, interfaces):
+            objects.setdefault(obj, {}).update(interfaces)
+
+        def removed_cb(obj, interfaces):
+            remaining = objects.get(obj, {})
+            for interface in interfaces:
+                remaining.pop(interface, None)
+            if not remaining:
+                objects.pop(obj, None)
+
+        self.watches[key] = [
+                self.bus.add_signal_receiver(
+                        callback, signal_name=name,
+                        dbus_interface=DBUS_OM_IFACE, bus_name=sender,
+                        path=path)
+                for callback, name in ((added_cb, 'InterfacesAdded'),
+                                       (removed_cb, 'InterfacesRemoved'))]
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE,
+                         in_signature='oa{sv}',
+                         sender_keyword='sender',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def RegisterAdvertisement(self, path, options, sender=None,
+                              reply_handler=None, error_handler=None):
+        key = (str(sender), str(path))
+
+        def props_cb(props):
+            self.advertisements[key] = props
+            reply_handler()
+
+        def props_error_cb(error):
+            error_handler(FailedException(str(error)))
+
+        props = dbus.Interface(self.bus.get_object(sender, path),
+                               DBUS_PROP_IFACE)
+        props.GetAll(LE_ADVERTISEMENT_IFACE, reply_handler=props_cb,
+                     error_handler=props_error_cb)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE,
+                         in_signature='o',
+                         sender_keyword='sender')
+    def UnregisterAdvertisement(self, path, sender=None):
+        if self.advertisements.pop((str(sender), str(path)), None) is None:
+            raise InvalidArgsException()
+
+    @dbus.service.method(MOCK_CONTROL_IFACE, out_signature='a(sosas)')
+    def ListCharacteristics(self):
+        # (owner, path, UUID, flags) of every registered characteristic
+        result = []
+        for (sender, app), objects in self.applications.items():
+            for path, interfaces in objects.items():
+                chrc = interfaces.get(GATT_CHRC_IFACE)
+                if chrc is None:
+                    continue
+                result.append(dbus.Struct(
+                        (sender, path, chrc['UUID'],
+                         dbus.Array(chrc['Flags'], signature='s')),
+                        signature='sosas'))
+        return result
+
+    @dbus.service.method(MOCK_CONTROL_IFACE, out_signature='i')
+    def CountAdvertisements(self):
+        return len(self.advertisements)
+
+
+def main():
+    setup_logging()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    bus = dbus.SystemBus()
+    name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+    adapters = [MockAdapter(bus, 0)]
+    manager = MockObjectManager(bus, adapters)
+
+    logger.info('Mock BlueZ running on %s', bus.get_unique_name())
+    GObject.MainLoop().run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+import logging
+import unittest
+
+import gatt_core
+
+from gatt_core import CharacteristicMixin, TickScheduler
+
+
+class InvalidOffset(Exception):
+    pass
+
+
+class InvalidValueLength(Exception):
+    pass
+
+
+class Rejected(Exception):
+    pass
+
+
+class FakeCharacteristic(CharacteristicMixin):
+    InvalidOffsetException = InvalidOffset
+    InvalidValueLengthException = InvalidValueLength
+
+    def __init__(self, value_length=None, max_value_length=None):
+        self.value_length = value_length
+        self.max_value_length = max_value_length
+        self.read_views = {}
+        self.write_buffers = {}
+        self.value = bytearray()
+        self.reads = 0
+        self.writes = []
+        self.reject = False
+
+    def encode(self, value):
+        return bytes(value)
+
+    def read_value_async(self, options, callback, error_handler):
+        self.reads += 1
+        callback(self.value)
+
+    def write_value_async(self, value, options, reply_handler,
+                          error_handler):
+        self.writes.append((bytes(value), options))
+        if self.reject:
+            raise Rejected()
+        reply_handler()
+
+
+class Replies(object):
+    def __init__(self):
+        self.values = []
+        self.errors = []
+
+    def reply(self, value=None):
+        self.values.append(value)
+
+    def error(self, error):
+        self.errors.append(error)
+
+
+class LongValueWriteTest(unittest.TestCase):
+    def write(self, chrc, data, **options):
+        options.setdefault('device', 'dev0')
+        replies = Replies()
+        chrc.write_request(data, options, replies.reply, replies.error)
+        return replies
+
+    def test_offset_zero_goes_to_handler(self):
+        chrc = FakeCharacteristic(max_value_length=100)
+        replies = self.write(chrc, b'\x01' * 20, mtu=25)
+        self.assertEqual(chrc.writes, [(b'\x01' * 20,
+                                        {'device': 'dev0', 'mtu': 25})])
+        self.assertEqual(replies.values, [None])
+
+    def test_offset_zero_handler_error_reaches_caller(self):
+        # 20 bytes at mtu 25 is exactly one Prepare Write chunk
+        chrc = FakeCharacteristic(max_value_length=100)
+        chrc.reject = True
+        self.assertRaises(Rejected, self.write, chrc, b'\x01' * 20, mtu=25)
+        self.assertEqual(chrc.write_buffers, {})
+
+    def test_fixed_length(self):
+        chrc = FakeCharacteristic(value_length=4)
+        self.assertRaises(InvalidValueLength, self.write, chrc, b'\x01')
+        self.assertRaises(InvalidValueLength, self.write, chrc, b'\x01' * 5)
+        self.write(chrc, b'\x01' * 4)
+        self.assertEqual(len(chrc.writes), 1)
+
+    def test_max_length(self):
+        chrc = FakeCharacteristic(max_value_length=4)
+        self.assertRaises(InvalidValueLength, self.write, chrc, b'\x01' * 5)
+        self.write(chrc, b'\x01')
+        self.assertEqual(chrc.writes[0][0], b'\x01')
+
+    def test_offset_patches_last_value(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.write(chrc, b'abcd')
+        replies = self.write(chrc, b'XY', offset=2)
+        self.assertEqual(chrc.writes[1], (b'abXY', {'device': 'dev0'}))
+        self.assertEqual(replies.values, [None])
+        self.write(chrc, b'Z', offset=4)
+        self.assertEqual(chrc.writes[2][0], b'abXYZ')
+
+    def test_offset_is_per_device(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.write(chrc, b'abcd', device='dev0')
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=1,
+                          device='dev1')
+
+    def test_offset_without_value(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=1)
+        self.assertEqual(chrc.writes, [])
+
+    def test_offset_past_end(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.write(chrc, b'ab')
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=3)
+
+    def test_offset_past_limit(self):
+        chrc = FakeCharacteristic(max_value_length=4)
+        self.write(chrc, b'abcd')
+        self.assertRaises(InvalidValueLength, self.write, chrc, b'XY',
+                          offset=3)
+
+    def test_offset_without_limit(self):
+        chrc = FakeCharacteristic()
+        self.write(chrc, b'abcd')
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=1)
+
+    def test_rejected_value_is_not_patched(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.write(chrc, b'abcd')
+        chrc.reject = True
+        self.assertRaises(Rejected, self.write, chrc, b'efgh')
+        chrc.reject = False
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=1)
+
+    def test_drop_write_buffer(self):
+        chrc = FakeCharacteristic(max_value_length=8)
+        self.write(chrc, b'abcd')
+        chrc.drop_write_buffer('dev0')
+        chrc.drop_write_buffer('dev0')
+        self.assertRaises(InvalidOffset, self.write, chrc, b'X', offset=1)
+
+
+class LongValueReadTest(unittest.TestCase):
+    def read(self, chrc, **options):
+        options.setdefault('device', 'dev0')
+        replies = Replies()
+        chrc.read_request(options, replies.reply, replies.error)
+        return replies
+
+    def test_whole_value(self):
+        chrc = FakeCharacteristic()
+        chrc.value = bytearray(b'abcd')
+        self.assertEqual(self.read(chrc).values, [b'abcd'])
+
+    def test_read_blob_uses_one_value(self):
+        chrc = FakeCharacteristic()
+        chrc.value = bytearray(range(40))
+        first = self.read(chrc, mtu=23).values[0]
+        self.assertEqual(first, bytes(bytearray(range(22))))
+        chrc.value = bytearray(b'changed')
+        rest = self.read(chrc, offset=22, mtu=23).values[0]
+        self.assertEqual(rest, bytes(bytearray(range(22, 40))))
+        self.assertEqual(chrc.reads, 1)
+
+    def test_read_blob_past_end(self):
+        chrc = FakeCharacteristic()
+        chrc.value = bytearray(b'abcd')
+        self.read(chrc)
+        self.assertRaises(InvalidOffset, self.read, chrc, offset=5)
+
+    def test_offset_read_without_sequence(self):
+        chrc = FakeCharacteristic()
+        chrc.value = bytearray(b'abcd')
+        replies = self.read(chrc, offset=2)
+        self.assertEqual(replies.values, [b'cd'])
+
+    def test_offset_read_past_end_without_sequence(self):
+        chrc = FakeCharacteristic()
+        chrc.value = bytearray(b'abcd')
+        replies = self.read(chrc, offset=5)
+        self.assertEqual(len(replies.errors), 1)
+        self.assertTrue(isinstance(replies.errors[0], InvalidOffset))
+
+
+class FakeContext(object):
+    def __init__(self):
+        self.sources = {}
+        self.next_id = 1
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        source_id = self.next_id
+        self.next_id += 1
+        self.sources[source_id] = (interval, callback)
+        return source_id
+
+    def source_remove(self, source_id):
+        del self.sources[source_id]
+
+
+class TickSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.saved_context = gatt_core.main_context
+        gatt_core.set_main_context(FakeContext())
+        logging.getLogger('gatt_core').disabled = True
+
+    def tearDown(self):
+        gatt_core.set_main_context(self.saved_context)
+        logging.getLogger('gatt_core').disabled = False
+
+    def test_failing_task_keeps_timer(self):
+        scheduler = TickScheduler()
+        runs = []
+
+        def fail():
+            raise ValueError()
+
+        scheduler.add(1, fail)
+        scheduler.add(1, lambda: runs.append(1) or True)
+        for i in range(3):
+            self.assertTrue(scheduler.tick_cb())
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(scheduler.get_stats()['errors'], 3)
+        self.assertEqual(list(gatt_core.main_context.sources),
+                         [scheduler.timer_id])
+
+    def test_task_ends_on_false(self):
+        scheduler = TickScheduler()
+        scheduler.add(1, lambda: False)
+        self.assertFalse(scheduler.tick_cb())
+        self.assertEqual(scheduler.timer_id, None)
+
+
+if __name__ == '__main__':
+    unittest.main()